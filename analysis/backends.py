@@ -0,0 +1,177 @@
+import logging
+import os
+import sys
+
+import numpy as np
+import torch
+import transformers
+
+from utils import sigmoid
+
+# "torch" runs the model as downloaded (fp32). "torch-int8" applies dynamic
+# int8 quantization to its Linear layers, "onnx" exports it to ONNX Runtime
+# and "onnx-int8" quantizes that export. The ONNX backends need onnxruntime
+# (pip install onnxruntime), which is only imported when one is chosen.
+BACKENDS = ["torch", "torch-int8", "onnx", "onnx-int8"]
+
+# ONNX exports are kept here so later jobs can skip the conversion
+MODEL_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models")
+
+# A few sentences to compare backends on when no reference file is given
+REFERENCE_SENTENCES = [
+    "I can't believe you came back for me",
+    "He slammed the door so hard the windows rattled",
+    "She laughed until she cried, and then she just cried",
+    "The house was quiet now, emptier than it had ever been",
+    "Thank you, really, I mean it",
+    "What do you mean he's gone?",
+    "Honestly I don't care what they think anymore",
+    "It was the best birthday she'd had in years",
+    "Don't touch me",
+    "Maybe tomorrow will be different",
+]
+
+
+class TorchBackend:
+    """The PyTorch model, optionally with dynamically quantized Linear layers.
+
+    Quantizing takes a few seconds and needs the fp32 model loaded anyway,
+    so "torch-int8" is converted on each start rather than cached.
+    """
+
+    def __init__(self, model, quantize=False):
+        self.model = model.eval()
+        if quantize:
+            self.model = torch.ao.quantization.quantize_dynamic(
+                self.model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+
+    def logits(self, input_ids, attention_mask):
+        with torch.no_grad():
+            return self.model(
+                input_ids=torch.from_numpy(input_ids),
+                attention_mask=torch.from_numpy(attention_mask),
+            ).logits.numpy()
+
+
+class OnnxBackend:
+    """The model exported to ONNX and run with ONNX Runtime."""
+
+    def __init__(self, model, quantize=False, cache_dir=MODEL_CACHE_DIR):
+        import onnxruntime
+
+        path = artifact_path(cache_dir, model, "onnx", "onnx")
+        if not os.path.exists(path):
+            self.export(model, path)
+
+        if quantize:
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            fp32_path = path
+            path = artifact_path(cache_dir, model, "onnx-int8", "onnx")
+            if not os.path.exists(path):
+                quantize_dynamic(fp32_path, path, weight_type=QuantType.QInt8)
+                logging.info(f"Saved quantized ONNX model to {path}.")
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = torch.get_num_threads()
+        self.session = onnxruntime.InferenceSession(
+            path, options, providers=["CPUExecutionProvider"]
+        )
+        logging.info(f"Loaded ONNX model from {path}.")
+
+    @staticmethod
+    def export(model, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        input_ids = torch.ones((2, 8), dtype=torch.long)
+        attention_mask = torch.ones((2, 8), dtype=torch.long)
+        # Write under a temporary name so an interrupted export isn't reused
+        partial_path = path + ".partial"
+        with torch.no_grad():
+            torch.onnx.export(
+                model.eval(),
+                (input_ids, attention_mask),
+                partial_path,
+                input_names=["input_ids", "attention_mask"],
+                output_names=["logits"],
+                dynamic_axes={
+                    "input_ids": {0: "batch", 1: "tokens"},
+                    "attention_mask": {0: "batch", 1: "tokens"},
+                    "logits": {0: "batch"},
+                },
+                opset_version=17,
+                dynamo=False,
+            )
+        os.replace(partial_path, path)
+        logging.info(f"Exported ONNX model to {path}.")
+
+    def logits(self, input_ids, attention_mask):
+        return self.session.run(
+            ["logits"], {"input_ids": input_ids, "attention_mask": attention_mask}
+        )[0]
+
+
+def artifact_path(cache_dir, model, backend, extension):
+    """Where a converted model lives, keyed by the versions that produced it."""
+    model_name = model.config.name_or_path.replace("/", "--")
+    versions = f"torch{torch.__version__}-transformers{transformers.__version__}"
+    if backend.startswith("onnx"):
+        import onnxruntime
+
+        versions += f"-onnxruntime{onnxruntime.__version__}"
+    return os.path.join(cache_dir, model_name, f"{backend}-{versions}.{extension}")
+
+
+def load_backend(name, model, cache_dir=MODEL_CACHE_DIR):
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend {name!r}, expected one of {BACKENDS}")
+
+    quantize = name.endswith("-int8")
+    if name.startswith("onnx"):
+        return OnnxBackend(model, quantize, cache_dir)
+    return TorchBackend(model, quantize)
+
+
+def compare_backends(sentences, model, tokenizer, backend):
+    """Largest absolute score difference per label between `backend` and fp32.
+
+    Scores are the sigmoid outputs `score_emotions` returns. Returns a dict
+    of label -> max deviation over `sentences`.
+    """
+    inputs = tokenizer(sentences, padding=True, truncation=True, return_tensors="np")
+    input_ids = inputs["input_ids"].astype(np.int64)
+    attention_mask = inputs["attention_mask"].astype(np.int64)
+
+    reference = TorchBackend(model).logits(input_ids, attention_mask)
+    candidate = backend.logits(input_ids, attention_mask)
+    deviation = np.abs(sigmoid(reference) - sigmoid(candidate)).max(axis=0)
+
+    labels = [model.config.id2label[i] for i in range(len(deviation))]
+    return dict(zip(labels, deviation.tolist()))
+
+
+if __name__ == "__main__":
+    # Usage: python backends.py [backend] [reference.txt]
+    # Converts the model for `backend` (reusing a cached ONNX export) and
+    # reports its per-label deviation from the fp32 model. The reference
+    # file holds one sentence per line.
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python backends.py [backend] [reference.txt]")
+        sys.exit(-1)
+
+    from sentiment import get_model, get_tokenizer
+
+    model = get_model()
+    tokenizer = get_tokenizer()
+
+    if len(sys.argv) == 3:
+        with open(sys.argv[2], "r", encoding="utf-8") as file:
+            sentences = [line.strip() for line in file if line.strip()]
+    else:
+        sentences = REFERENCE_SENTENCES
+
+    backend = load_backend(sys.argv[1], model)
+    deviations = compare_backends(sentences, model, tokenizer, backend)
+    for label, deviation in sorted(deviations.items(), key=lambda item: -item[1]):
+        print(f"{label:<16} {deviation:.6f}")
+    print(f"Max deviation over {len(sentences)} sentences: {max(deviations.values()):.6f}")
@@ -1,8 +1,15 @@
-import pandas as pd
-import numpy as np
-import zipfile
+import heapq
+import io
 import os
+import pickle
 import re
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from process import estimate_cost
 from utils import create_open
 
 # Define base directory paths
@@ -11,21 +18,124 @@ output_base_dir = (
     "/scratch/tripakis.m/data-research/fanfic/splits/"  # Directory to save split files
 )
 
-# Ensure the output base directory exists
-os.makedirs(output_base_dir, exist_ok=True)
-
 # Define a regular expression pattern to match names like "03.21-09.21 Mikko Tripakis"
 pattern = re.compile(r"\d{2}\.\d{2}-\d{2}\.\d{2} Mikko Tripakis(\.zip)?$")
 
+# Rows read from a table at a time, which bounds memory however big it is
+CHUNK_ROWS = 20000
 
-# Function to split and save DataFrame and print stats
-def split_and_save(df, output_dir, num_splits=40):
-    # Split the data into parts
-    df_splits = np.array_split(df, num_splits)
-    stats = []
+
+def data_files(filenames):
+    """Scraped tables to read, preferring a .parquet over its .csv twin."""
+    parquet_stems = {
+        name[: -len(".parquet")] for name in filenames if name.endswith(".parquet")
+    }
+    return [
+        name
+        for name in filenames
+        if name.endswith(".parquet")
+        or (name.endswith(".csv") and name[: -len(".csv")] not in parquet_stems)
+    ]
+
+
+def read_chunks(file, filename, columns=None):
+    """Yield a table's rows as DataFrames of at most CHUNK_ROWS rows.
+
+    `columns` limits what is read from Parquet; CSVs are always read whole.
+    """
+    if filename.endswith(".parquet"):
+        parquet_file = pq.ParquetFile(file)
+        if columns is not None:
+            columns = [col for col in columns if col in parquet_file.schema_arrow.names]
+        for batch in parquet_file.iter_batches(batch_size=CHUNK_ROWS, columns=columns):
+            yield batch.to_pandas()
+    else:
+        # Parsing a CSV costs the same whichever columns are kept
+        yield from pd.read_csv(file, chunksize=CHUNK_ROWS)
+
+
+def iter_chunks(entry_path, columns=None):
+    """Yield every table in a ZIP file or folder, chunk by chunk, in a fixed order."""
+    if entry_path.endswith(".zip"):
+        with zipfile.ZipFile(entry_path, "r") as zip_file:
+            for filename in sorted(data_files(zip_file.namelist())):
+                if filename.endswith(".parquet"):
+                    # Parquet needs a seekable file
+                    yield from read_chunks(
+                        io.BytesIO(zip_file.read(filename)), filename, columns
+                    )
+                else:
+                    with zip_file.open(filename) as csv_file:
+                        yield from read_chunks(csv_file, filename, columns)
+
+    elif os.path.isdir(entry_path):
+        for filename in sorted(data_files(os.listdir(entry_path))):
+            yield from read_chunks(os.path.join(entry_path, filename), filename, columns)
+
+
+def text_cost(text):
+    if not isinstance(text, str):
+        return 0.0
+    return estimate_cost(len(text.split()))
+
+
+def assign_parts(costs, num_splits):
+    """Deal works out to parts, most expensive first, to the cheapest part so far."""
+    parts = np.empty(len(costs), dtype=np.int64)
+    loads = [(0.0, part) for part in range(num_splits)]
+    for row in np.argsort(-costs, kind="stable"):
+        load, part = heapq.heappop(loads)
+        parts[row] = part
+        heapq.heappush(loads, (load + costs[row], part))
+    return parts
+
+
+def split_and_save(entry_path, output_dir, num_splits=40):
+    """Split one ZIP/folder of scraped tables into parts of balanced cost.
+
+    The tables are streamed twice: once to estimate each work's cost from
+    its text (only the text column of Parquet tables is read), then in full
+    to send each row to its part.
+    Rows are spilled to a file per part as they come, and each part is only
+    put together at the end, so no more than a chunk and one part are in
+    memory at once.
+    """
+    costs = np.array(
+        [
+            text_cost(text)
+            for chunk in iter_chunks(entry_path, columns=["text"])
+            for text in chunk.get("text", [None] * len(chunk))
+        ],
+        dtype=np.float64,
+    )
+    parts = assign_parts(costs, num_splits)
+
+    spill_paths = [f"{output_dir}/fanfics_part_{i}.spill" for i in range(num_splits)]
+    spill_files = [create_open(path, "wb") for path in spill_paths]
+    start = 0
+    for chunk in iter_chunks(entry_path):
+        chunk_parts = parts[start : start + len(chunk)]
+        for part in np.unique(chunk_parts):
+            pickle.dump(chunk[chunk_parts == part], spill_files[part])
+        start += len(chunk)
+    for file in spill_files:
+        file.close()
+    if start != len(costs):
+        raise ValueError(f"{entry_path} changed while it was being split")
 
     # Save each part and collect statistics
-    for i, df_part in enumerate(df_splits):
+    stats = []
+    for i, spill_path in enumerate(spill_paths):
+        pieces = []
+        with open(spill_path, "rb") as file:
+            while True:
+                try:
+                    pieces.append(pickle.load(file))
+                except EOFError:
+                    break
+        os.remove(spill_path)
+
+        df_part = pd.concat(pieces, ignore_index=True) if pieces else pd.DataFrame()
         part_filename = f"{output_dir}/fanfics_part_{i}.pkl"
         with create_open(part_filename, "wb") as file:
             df_part.to_pickle(file)
@@ -34,6 +144,7 @@ def split_and_save(df, output_dir, num_splits=40):
         part_stats = {
             "part": i + 1,
             "fanfics_count": len(df_part),
+            "cost": costs[parts == i].sum(),
             "filename": part_filename,
         }
         stats.append(part_stats)
@@ -42,43 +153,26 @@ def split_and_save(df, output_dir, num_splits=40):
     print(f"\nSaved {num_splits} parts to {output_dir}")
     for stat in stats:
         print(
-            f"Part {stat['part']}: {stat['fanfics_count']} fanfics - saved to {stat['filename']}"
+            f"Part {stat['part']}: {stat['fanfics_count']} fanfics, "
+            f"estimated cost {stat['cost']:,.0f} - saved to {stat['filename']}"
         )
-    print(
-        f"Total fanfics in this collection: {sum(s['fanfics_count'] for s in stats)}\n"
-    )
+    print(f"Total fanfics in this collection: {len(costs)}\n")
 
 
-# Loop through each entry in base_dir
-for entry in os.listdir(base_dir):
-    entry_path = os.path.join(base_dir, entry)
-    if pattern.match(entry):  # Only process entries matching the pattern
+if __name__ == "__main__":
+    # Ensure the output base directory exists
+    os.makedirs(output_base_dir, exist_ok=True)
 
-        # Set up directory for output specific to this ZIP or folder
-        entry_output_dir = os.path.join(
-            output_base_dir, entry.replace(".zip", "").replace(" Mikko Tripakis", "")
-        )
-        os.makedirs(entry_output_dir, exist_ok=True)
-
-        # Initialize an empty DataFrame for this ZIP/folder
-        all_data = pd.DataFrame()
-
-        # Check if the entry is a ZIP file
-        if entry.endswith(".zip"):
-            with zipfile.ZipFile(entry_path, "r") as zip_file:
-                for csv_filename in zip_file.namelist():
-                    if csv_filename.endswith(".csv"):
-                        with zip_file.open(csv_filename) as csv_file:
-                            df = pd.read_csv(csv_file)
-                            all_data = pd.concat([all_data, df], ignore_index=True)
-
-        # If it's a folder, read CSVs directly from the folder
-        elif os.path.isdir(entry_path):
-            for csv_filename in os.listdir(entry_path):
-                if csv_filename.endswith(".csv"):
-                    csv_path = os.path.join(entry_path, csv_filename)
-                    df = pd.read_csv(csv_path)
-                    all_data = pd.concat([all_data, df], ignore_index=True)
-
-        # Split, save, and print stats
-        split_and_save(all_data, entry_output_dir)
+    # Loop through each entry in base_dir
+    for entry in os.listdir(base_dir):
+        entry_path = os.path.join(base_dir, entry)
+        if pattern.match(entry):  # Only process entries matching the pattern
+
+            # Set up directory for output specific to this ZIP or folder
+            entry_output_dir = os.path.join(
+                output_base_dir, entry.replace(".zip", "").replace(" Mikko Tripakis", "")
+            )
+            os.makedirs(entry_output_dir, exist_ok=True)
+
+            # Split, save, and print stats
+            split_and_save(entry_path, entry_output_dir)
@@ -0,0 +1,136 @@
+import contextlib
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+from utils import create_open
+
+# Seconds between stack samples; set ANALYSIS_PROFILE_INTERVAL (e.g. 0.01)
+# to profile every part a process works on
+PROFILE_INTERVAL = float(os.environ.get("ANALYSIS_PROFILE_INTERVAL", 0)) or None
+
+
+class Metrics:
+    """Time and calls per pipeline stage, plus counters, for one run.
+
+    Stages are timed with `with METRICS.stage("name"):`; `count` adds to a
+    counter (works, windows, sentences, tokens). `report` puts them
+    together with throughput and the process's peak RSS.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started = time.perf_counter()
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+        self.counters = defaultdict(int)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+            self.calls[name] += 1
+
+    def count(self, name, value=1):
+        self.counters[name] += value
+
+    def report(self):
+        wall = time.perf_counter() - self.started
+        model_seconds = self.seconds.get("model", 0.0)
+        return {
+            "wall_seconds": wall,
+            "stages": {
+                name: {
+                    "seconds": seconds,
+                    "calls": self.calls[name],
+                    "share": seconds / wall if wall else 0.0,
+                }
+                for name, seconds in sorted(self.seconds.items())
+            },
+            "counters": dict(self.counters),
+            "rates": {
+                "works_per_second": self.counters["works"] / wall if wall else 0.0,
+                # Model throughput, over the time spent in the model
+                "sentences_per_second": (
+                    self.counters["sentences"] / model_seconds if model_seconds else 0.0
+                ),
+                "tokens_per_second": (
+                    self.counters["tokens"] / model_seconds if model_seconds else 0.0
+                ),
+            },
+            "peak_rss_mb": peak_rss_mb(),
+        }
+
+    def write(self, path):
+        with create_open(path + ".partial", "w") as file:
+            json.dump(self.report(), file, indent=2)
+        os.replace(path + ".partial", path)
+
+    def summary(self):
+        """One line of the stages that took the most time."""
+        wall = time.perf_counter() - self.started
+        stages = sorted(self.seconds.items(), key=lambda item: -item[1])
+        return ", ".join(
+            f"{name} {seconds:.1f}s ({seconds / wall:.0%})" for name, seconds in stages
+        )
+
+
+def peak_rss_mb():
+    """Largest resident set size of this process so far, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+class Sampler:
+    """Sampling profiler for the thread that starts it.
+
+    A background thread records that thread's stack every `interval`
+    seconds. `write` saves the samples as collapsed stacks
+    ("file:function;file:function count" per line), which flamegraph.pl
+    and speedscope can show.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        thread_id = threading.get_ident()
+
+        def sample():
+            while not self.stop_event.wait(self.interval):
+                frame = sys._current_frames().get(thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+
+        self.thread = threading.Thread(target=sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+
+    def write(self, path):
+        with create_open(path, "w") as file:
+            file.writelines(f"{stack} {n}\n" for stack, n in self.stacks.most_common())
+
+
+# Metrics of the run in progress in this process
+METRICS = Metrics()
@@ -0,0 +1,128 @@
+import numpy as np
+
+from utils import split_text_into_chunks
+
+
+class TokenizedWork:
+    """Model inputs for the sentences of many windows over the words of one work.
+
+    `split_text_into_chunks` of a window, fed through the tokenizer, gives
+    the same token IDs as slicing a tokenization of the whole work: words
+    are joined by single spaces, so a sentence break (". ") can only come
+    after a word ending in "." and the byte-level tokenizer never merges
+    across the space between two words. Only the words at a sentence's
+    edges tokenize differently on their own (no leading space, "." cut
+    off); those are tokenized as needed and kept.
+
+    A work with anything like an HTML tag in it falls back to splitting
+    window text, since tag stripping can join or cut words.
+    """
+
+    def __init__(self, tokenizer, words):
+        self.tokenizer = tokenizer
+        self.words = words
+        self.has_tags = any("<" in word for word in words)
+        self.max_tokens = (
+            tokenizer.model_max_length - tokenizer.num_special_tokens_to_add()
+        )
+
+        self.ends_sentence = np.array(
+            [word.endswith(".") for word in words], dtype=bool
+        )
+        self.variants = {}
+        self.sentences = {}
+        if self.has_tags:
+            return
+
+        # The whole work once, each word with the leading space it has
+        # inside a window
+        encoding = tokenizer(
+            " " + " ".join(words),
+            add_special_tokens=False,
+            return_offsets_mapping=True,
+            verbose=False,
+        )
+        self.ids = encoding["input_ids"]
+        word_starts = np.cumsum([1] + [len(word) + 1 for word in words[:-1]])
+        # Offsets leave out the leading space, so each token starts inside
+        # its word (a bare space token starts where its word does)
+        token_starts = np.array(
+            [start for start, _ in encoding["offset_mapping"]], dtype=np.int64
+        )
+        token_words = np.searchsorted(word_starts, token_starts, side="right") - 1
+        self.bounds = np.searchsorted(token_words, np.arange(len(words) + 1)).tolist()
+
+    def tokenize_variants(self, keys):
+        """Tokenize the (word, leading_space, strip_period) variants not seen yet."""
+        missing = [key for key in dict.fromkeys(keys) if key not in self.variants]
+        if not missing:
+            return
+        texts = []
+        for word, leading_space, strip_period in missing:
+            text = self.words[word][:-1] if strip_period else self.words[word]
+            texts.append(" " + text if leading_space else text)
+        tokenized = self.tokenizer(texts, add_special_tokens=False, verbose=False)
+        self.variants.update(zip(missing, tokenized["input_ids"]))
+
+    def window_sentences(self, start, end):
+        """`split_text_into_chunks(" ".join(words[start:end]))` as token ID tuples."""
+        if self.has_tags:
+            return split_text_into_chunks(" ".join(self.words[start:end]))
+
+        # Sentences are words [a, b); all but the window's last drop their "."
+        breaks = np.flatnonzero(self.ends_sentence[start : end - 1]) + start + 1
+        edges = [start] + breaks.tolist() + [end]
+        spans = [(a, b, b < end) for a, b in zip(edges[:-1], edges[1:])]
+
+        keys = []
+        for a, b, strip_period in spans:
+            if (a, b, strip_period) in self.sentences:
+                continue
+            if b - a == 1:
+                keys.append((a, False, strip_period))
+            else:
+                keys.append((a, False, False))
+                if strip_period:
+                    keys.append((b - 1, True, True))
+        self.tokenize_variants(keys)
+
+        return [self.sentence(a, b, strip_period) for a, b, strip_period in spans]
+
+    def sentence(self, a, b, strip_period):
+        key = (a, b, strip_period)
+        ids = self.sentences.get(key)
+        if ids is None:
+            if b - a == 1:
+                tokens = self.variants[(a, False, strip_period)]
+            else:
+                last = (
+                    self.variants[(b - 1, True, True)]
+                    if strip_period
+                    else self.ids[self.bounds[b - 1] : self.bounds[b]]
+                )
+                tokens = (
+                    self.variants[(a, False, False)]
+                    + self.ids[self.bounds[a + 1] : self.bounds[b - 1]]
+                    + last
+                )
+            tokens = tokens[: self.max_tokens]
+            ids = self.sentences[key] = tuple(
+                self.tokenizer.build_inputs_with_special_tokens(tokens)
+            )
+        return ids
+
+
+def token_mismatches(tokenizer, words, ranges):
+    """Number of windows whose sentences tokenize differently from window text."""
+    tokenized = TokenizedWork(tokenizer, words)
+    if tokenized.has_tags:
+        # Split from window text anyway
+        return 0
+
+    mismatches = 0
+    for start, end in ranges:
+        chunks = split_text_into_chunks(" ".join(words[start:end]))
+        expected = tokenizer(chunks, truncation=True)["input_ids"]
+        sentences = tokenized.window_sentences(start, end)
+        mismatches += [tuple(ids) for ids in expected] != list(sentences)
+    return mismatches
@@ -2,10 +2,14 @@ import logging
 import os
 import time
 
-import pandas as pd
+import numpy as np
 
-from sentiment import get_emotion_scores
-from utils import create_open, smooth_scores
+from metrics import METRICS, PROFILE_INTERVAL, Sampler
+from pretokenize import TokenizedWork
+from sentiment import EmotionBatcher, get_analyzer, get_tokenizer, score_columns
+from store import ResultStore
+from utils import smooth_score_array
+from vader import WindowedVader
 
 # Set up logging configuration
 fmt = f"%(filename)-20s:%(lineno)-4d %(asctime)s %(message)s"
@@ -18,144 +22,341 @@ logging.basicConfig(
 )
 
 
-def split_text_into_percentiles(text: str, window_size=500, num_windows=100):
-    words = text.split()
-    total_words = len(words)
+# Words of a work that are analyzed at most; the rest is ignored
+MAX_WORDS = 50000
+
+# Works whose windows share model batches, and in adaptive mode, where each
+# round only scores a few windows of each work
+WORKS_PER_BATCH = 8
+ADAPTIVE_WORKS_PER_BATCH = 32
+
+# Adaptive mode: windows scored first, spread evenly over the work; the
+# default largest change in any smoothed emotion score between neighbouring
+# scored windows that is left to interpolation; and the most windows between
+# two scored ones, so no change wider than that can be skipped entirely
+COARSE_WINDOWS = 11
+ADAPTIVE_THRESHOLD = 0.1
+MAX_GAP = 8
 
-    if total_words > 50000:
-        words = words[:50000]
-        total_words = 50000
+# Rough cost of a word that is only re-read by an overlapping window (VADER
+# and sentence splitting), relative to a word scored by the model. Each
+# distinct sentence is scored once, so the model cost follows the text.
+WINDOW_WORD_COST = 0.05
 
+
+def percentile_ranges(total_words, window_size=500, num_windows=100):
+    """(start, end) word offsets of the percentile windows over `total_words` words."""
     if total_words <= 0:
         return []
 
     if total_words <= window_size:
-        return [" ".join(words)]
+        return [(0, total_words)]
 
     segment_size = (total_words - (window_size + 1)) / num_windows
 
-    chunks = []
+    ranges = []
     for perc in range(1, num_windows + 1):
         start_point = int(segment_size * (perc - 1))
         end_point = start_point + window_size
         if end_point > total_words:
             end_point = total_words
+        ranges.append((start_point, end_point))
 
-        chunk_words = words[start_point:end_point]
-        chunk_text = " ".join(chunk_words)
-        chunks.append(chunk_text)
+    return ranges
 
-    return chunks
 
+def split_words_into_percentiles(text: str, window_size=500, num_windows=100):
+    """The words analyzed from `text` and the word ranges of its windows."""
+    words = text.split()[:MAX_WORDS]
+    return words, percentile_ranges(len(words), window_size, num_windows)
 
-def process_transcripts(df, output_file, num_percentiles=100, save_interval=4):
-    # Generate the summary file name automatically based on the output file
-    summary_file = output_file.replace(".pkl", "_summary.pkl")
 
-    # Load existing results if any
-    if os.path.exists(output_file):
-        existing_results = pd.read_pickle(output_file)
-        processed_transcript_ids = set(existing_results["url"].unique())
-        all_scores = existing_results.to_dict("records")  # Convert to list of dicts
-        logging.info(f"Loaded existing results from {output_file}.")
-    else:
-        all_scores = []
-        processed_transcript_ids = set()
-        logging.info("No existing results found. Starting fresh.")
+def split_text_into_percentiles(text: str, window_size=500, num_windows=100):
+    words, ranges = split_words_into_percentiles(text, window_size, num_windows)
+    return [" ".join(words[start:end]) for start, end in ranges]
 
-    # Load existing summary data if any
-    if os.path.exists(summary_file):
-        existing_summary = pd.read_pickle(summary_file)
-        summary_scores = existing_summary.to_dict("records")  # Convert to list of dicts
-        processed_summary_ids = set(existing_summary["url"].unique())
-        logging.info(f"Loaded existing summary data from {summary_file}.")
-    else:
-        summary_scores = []
-        processed_summary_ids = set()
-        logging.info("No existing summary data found. Starting fresh.")
 
-    total_transcripts = len(df)
-    start_time = time.time()
-    transcripts_processed = 0  # Counter for transcripts processed in this run
+def estimate_cost(num_words, window_size=500, num_windows=100):
+    """Relative cost of processing a work of `num_words` words.
 
-    for idx, (transcript_id, transcript_text) in enumerate(zip(df["url"], df["text"])):
-        if not transcript_id or not isinstance(transcript_text, str):
-            print(f"Skipping transcript {transcript_id}, no text found.")
+    Follows the window rule of `split_text_into_percentiles`: the text is
+    capped at MAX_WORDS, a work no longer than one window is a single
+    window, and anything longer is read as `num_windows` windows.
+    """
+    total_words = min(num_words, MAX_WORDS)
+    if total_words <= 0:
+        return 0.0
+
+    windows = 1 if total_words <= window_size else num_windows
+    window_words = windows * min(total_words, window_size)
+    return total_words + WINDOW_WORD_COST * window_words
+
+
+def score_works(works, works_per_batch, unique_sentences=True, adaptive_threshold=None):
+    """Score the percentile windows of several works at a time.
+
+    `works` yields (idx, transcript_id, words, ranges), as from
+    `split_words_into_percentiles`. The windows of up to
+    `works_per_batch` works share model batches; yields
+    (idx, transcript_id, percentile_scores, windows_scored) in the same
+    order, where percentile_scores is a (percentiles x columns) array laid
+    out as `score_columns()`.
+
+    With `unique_sentences`, each distinct sentence is scored once even
+    though overlapping windows repeat it (about 10 times over for a 5k-word
+    work); see `PARITY_TOLERANCE` in sentiment.py for how close that stays
+    to scoring every window separately.
+
+    With `adaptive_threshold`, only some windows are scored; see
+    `adaptive_windows`.
+    """
+    batch = []
+    for work in works:
+        batch.append(work)
+        if len(batch) < works_per_batch:
             continue
+        yield from score_work_batch(batch, unique_sentences, adaptive_threshold)
+        batch = []
+
+    if batch:
+        yield from score_work_batch(batch, unique_sentences, adaptive_threshold)
+
+
+def score_work_batch(batch, unique_sentences, adaptive_threshold=None):
+    # The tokenizer and VADER read each work once for all of its windows
+    readers = []
+    for _, _, words, _ in batch:
+        with METRICS.stage("tokenize"):
+            tokenized = TokenizedWork(get_tokenizer(), words)
+        with METRICS.stage("vader"):
+            vader = WindowedVader(get_analyzer(), words)
+        readers.append((tokenized, vader))
+
+    # Adaptive rounds overlap: a sentence already scored is not scored again
+    cache = {} if adaptive_threshold is not None else None
+
+    def score_emotions(wanted):
+        """Emotion scores of the windows `wanted[i]` (lists of indexes) of each work."""
+        batcher = EmotionBatcher(unique_sentences=unique_sentences, cache=cache)
+        for (tokenized, _), (_, _, _, ranges), indexes in zip(readers, batch, wanted):
+            with METRICS.stage("tokenize"):
+                for i in indexes:
+                    batcher.add_sentences(tokenized.window_sentences(*ranges[i]))
+
+        emotions = batcher.run()
+        start = 0
+        for indexes in wanted:
+            yield emotions[start : start + len(indexes)]
+            start += len(indexes)
+
+    all_ranges = [ranges for _, _, _, ranges in batch]
+    if adaptive_threshold is None:
+        wanted = [range(len(ranges)) for ranges in all_ranges]
+        works = [
+            (emotions, len(ranges))
+            for emotions, ranges in zip(score_emotions(wanted), all_ranges)
+        ]
+    else:
+        works = adaptive_windows(all_ranges, score_emotions, adaptive_threshold)
+
+    for (idx, transcript_id, _, ranges), (_, vader), (emotions, windows_scored) in zip(
+        batch, readers, works
+    ):
+        # VADER is cheap, so every window gets its exact score
+        with METRICS.stage("vader"):
+            pos = vader.window_pos(ranges)
+        # Laid out as `score_columns()`: VADER "pos", then the emotions
+        scores = np.column_stack([pos, emotions]).astype(np.float32)
+        yield idx, transcript_id, scores, windows_scored
+
+
+def adaptive_windows(
+    all_ranges, score_emotions, threshold, coarse=COARSE_WINDOWS, max_gap=MAX_GAP
+):
+    """Coarse-to-fine emotion scores of every window of several works.
+
+    `all_ranges` holds each work's window ranges, and `score_emotions`
+    scores the windows it is given (as in `score_work_batch`), reusing the
+    sentences it has scored before. `coarse` windows spread over each work
+    are scored first. Then, round by round, between two scored neighbours:
+
+    - if they overlap or touch, every window between them is scored, as
+      their sentences are all scored already but for the two cut at the
+      window edges;
+    - otherwise the window halfway is scored if they are more than
+      `max_gap` windows apart, or the smoothed curve (as
+      process_transcripts stores it) changes between them by more than
+      `threshold` in any emotion.
+
+    The windows left out are linearly interpolated from their scored
+    neighbours. Returns an (emotions, windows_scored) pair per work.
+    """
+    scored = [{} for _ in all_ranges]
+    wanted = []
+    for ranges in all_ranges:
+        spread = np.linspace(0, len(ranges) - 1, min(coarse, len(ranges)))
+        wanted.append(np.unique(spread.round().astype(int)).tolist())
+    while any(wanted):
+        for work_scored, indexes, emotions in zip(
+            scored, wanted, score_emotions(wanted)
+        ):
+            work_scored.update(zip(indexes, emotions))
+
+        wanted = []
+        for ranges, work_scored in zip(all_ranges, scored):
+            indexes = sorted(work_scored)
+            smoothed = smooth_score_array(interpolate_windows(len(ranges), work_scored))
+            work_wanted = []
+            for left, right in zip(indexes[:-1], indexes[1:]):
+                if right - left <= 1:
+                    continue
+                if ranges[left][1] >= ranges[right][0]:
+                    work_wanted.extend(range(left + 1, right))
+                elif (
+                    right - left > max_gap
+                    or np.abs(smoothed[right] - smoothed[left]).max() > threshold
+                ):
+                    work_wanted.append((left + right) // 2)
+            wanted.append(work_wanted)
+
+    return [
+        (interpolate_windows(len(ranges), work_scored), len(work_scored))
+        for ranges, work_scored in zip(all_ranges, scored)
+    ]
+
+
+def interpolate_windows(num_windows, scored):
+    """Scores of all `num_windows` windows, linear between the `scored` ones."""
+    indexes = sorted(scored)
+    points = np.array([scored[i] for i in indexes])
+    scores = np.empty((num_windows, points.shape[1]), dtype=np.float32)
+    for column in range(points.shape[1]):
+        scores[:, column] = np.interp(
+            np.arange(num_windows), indexes, points[:, column]
+        )
+    return scores
+
+
+def process_transcripts(
+    df,
+    output_file,
+    num_percentiles=100,
+    save_interval=4,
+    works_per_batch=None,
+    unique_sentences=True,
+    adaptive_threshold=None,
+    compact=True,
+    metrics_file=None,
+):
+    """Score, smooth and store every work of `df` not already in `output_file`.
+
+    With `compact` off, the new rows are only flushed to the store's chunks
+    (for workers sharing one output; see worker.process_queue) and nothing
+    is returned.
+
+    With `adaptive_threshold` (ADAPTIVE_THRESHOLD is a starting point),
+    a work's emotion scores are worked out coarse-to-fine and interpolated
+    between the windows scored (see `adaptive_windows`); VADER's "pos" is
+    exact for every window. The output keeps `num_percentiles` rows per
+    work, and the summary gets a `windows_scored` column. The model work
+    saved comes from long works, whose windows barely overlap; shorter
+    works end up fully scored at the usual cost. How far interpolated
+    scores stray depends on the model and the text and is not bounded:
+    bench/bench_analysis.py measures it, with a local copy of the model
+    for real figures.
+
+    `works_per_batch` defaults to WORKS_PER_BATCH, or to
+    ADAPTIVE_WORKS_PER_BATCH in adaptive mode.
+
+    Time per stage, counts and peak memory go to `metrics_file`, by default
+    `*_metrics.json` next to the output (see metrics.py).
+    """
+    if works_per_batch is None:
+        works_per_batch = (
+            WORKS_PER_BATCH if adaptive_threshold is None else ADAPTIVE_WORKS_PER_BATCH
+        )
 
-        current_time = time.time()
-
-        if transcript_id in processed_transcript_ids:
-            logging.info(f"Skipping transcript {transcript_id}, already processed.")
-            continue
+    METRICS.reset()
+    sampler = Sampler(PROFILE_INTERVAL).start() if PROFILE_INTERVAL else None
 
-        # Split text into percentiles
-        chunks = split_text_into_percentiles(
-            transcript_text, window_size=500, num_windows=num_percentiles
+    store = ResultStore(output_file)
+    with METRICS.stage("resume"):
+        processed_transcript_ids = store.done_urls()
+    if processed_transcript_ids:
+        logging.info(
+            f"Found {len(processed_transcript_ids)} works already processed "
+            f"for {output_file}."
         )
+    else:
+        logging.info("No existing results found. Starting fresh.")
 
-        percentile_scores = []
-        for chunk in chunks:
-            scores = get_emotion_scores(chunk)
-            percentile_scores.append(scores)
-
-        if not percentile_scores:
-            continue
+    total_transcripts = len(df)
+    start_time = time.time()
+    transcripts_processed = 0  # Counter for transcripts processed in this run
 
-        # Smooth scores across percentiles
-        smoothed_scores = {}
-        for key in percentile_scores[0].keys():
-            scores = [score[key] for score in percentile_scores if key in score]
-            smoothed_scores[key] = smooth_scores(scores)
-
-        # Append per-percentile smoothed scores to `all_scores`
-        for i in range(len(smoothed_scores["pos"])):
-            row = {"url": transcript_id, "percentile": i + 1}
-            row.update({k: smoothed_scores[k][i] for k in smoothed_scores})
-            all_scores.append(row)
-
-        # Calculate average for each emotion across percentiles
-        avg_emotions = {
-            f"avg_{emotion}": sum(smoothed_scores[emotion])
-            / len(smoothed_scores[emotion])
-            for emotion in smoothed_scores
-        }
-
-        # Calculate variance for each emotion across percentiles
-        var_emotions = {
-            f"var_{emotion}": sum(
-                (x - avg_emotions[f"avg_{emotion}"]) ** 2
-                for x in smoothed_scores[emotion]
+    def pending_works():
+        for idx, (transcript_id, transcript_text) in enumerate(
+            zip(df["url"], df["text"])
+        ):
+            if not transcript_id or not isinstance(transcript_text, str):
+                print(f"Skipping transcript {transcript_id}, no text found.")
+                continue
+
+            if transcript_id in processed_transcript_ids:
+                logging.info(f"Skipping transcript {transcript_id}, already processed.")
+                continue
+
+            # Split text into percentiles
+            with METRICS.stage("split"):
+                words, ranges = split_words_into_percentiles(
+                    transcript_text, window_size=500, num_windows=num_percentiles
+                )
+            if ranges:
+                yield idx, transcript_id, words, ranges
+
+    for idx, transcript_id, percentile_scores, windows_scored in score_works(
+        pending_works(), works_per_batch, unique_sentences, adaptive_threshold
+    ):
+        current_time = time.time()
+        METRICS.count("works")
+        METRICS.count("windows", len(percentile_scores))
+        METRICS.count("windows_scored", windows_scored)
+
+        with METRICS.stage("smooth"):
+            # Smooth scores across percentiles, every emotion at once
+            smoothed_scores = smooth_score_array(percentile_scores)
+
+            # Average and variance of each emotion across percentiles
+            avg_emotions = smoothed_scores.mean(axis=0)
+            var_emotions = smoothed_scores.var(axis=0)
+
+            # Create a row for the summary DataFrame
+            columns = score_columns()
+            summary_row = {"url": transcript_id}
+            summary_row.update(
+                (f"avg_{emotion}", avg)
+                for emotion, avg in zip(columns, avg_emotions.tolist())
             )
-            / len(smoothed_scores[emotion])
-            for emotion in smoothed_scores
-        }
-
-        # Calculate the average of these variances across all emotions
-        avg_variance_across_emotions = sum(var_emotions.values()) / len(var_emotions)
-
-        # Create a row for the summary DataFrame
-        summary_row = {"url": transcript_id}
-        summary_row.update(avg_emotions)
-        summary_row["avg_variance_across_emotions"] = avg_variance_across_emotions
-        summary_scores.append(summary_row)
+            summary_row["avg_variance_across_emotions"] = float(var_emotions.mean())
+            if adaptive_threshold is not None:
+                summary_row["windows_scored"] = windows_scored
+        store.add(
+            transcript_id, columns, smoothed_scores.astype(np.float32), summary_row
+        )
 
         # Increment the counter
         transcripts_processed += 1
 
-        # Periodically save intermediate results
+        # Periodically write the new rows
         if transcripts_processed % save_interval == 0:
-            with create_open(output_file, "wb") as file:
-                pd.DataFrame(all_scores).to_pickle(file)
-                logging.info(f"Saved intermediate results to {output_file}.")
-
-            with create_open(summary_file, "wb") as file:
-                pd.DataFrame(summary_scores).to_pickle(file)
-                logging.info(f"Saved intermediate summary to {summary_file}.")
+            with METRICS.stage("checkpoint"):
+                store.flush()
+            logging.info(f"Saved intermediate results for {output_file}.")
 
         # Log progress
         transcripts_remaining = total_transcripts - idx - 1
-        avg_time_per_transcript = (current_time - start_time) / (idx + 1)
+        # Works skipped as done or empty take no time, so they don't count
+        avg_time_per_transcript = (current_time - start_time) / transcripts_processed
 
         logging.info(
             f"Processed {idx + 1}/{total_transcripts} transcripts. "
@@ -163,11 +364,36 @@ def process_transcripts(df, output_file, num_percentiles=100, save_interval=4):
             f"Average time per transcript: {avg_time_per_transcript:.2f} seconds."
         )
 
-    # Save final results
-    pd.DataFrame(all_scores).to_pickle(output_file)
-    pd.DataFrame(summary_scores).to_pickle(summary_file)
+    windows = METRICS.counters["windows"]
+    windows_scored = METRICS.counters["windows_scored"]
+    if adaptive_threshold is not None and windows:
+        logging.info(
+            f"Scored {windows_scored} of {windows} windows "
+            f"({windows_scored / windows:.0%}), the rest interpolated."
+        )
+
+    # Merge the chunks into the final results
+    with METRICS.stage("checkpoint"):
+        if compact:
+            all_scores, summary_scores = store.compact()
+        else:
+            store.flush()
+
+    # Per-stage times and counts, for sizing jobs and finding slow stages
+    metrics_file = metrics_file or output_file.replace(".pkl", "_metrics.json")
+    METRICS.write(metrics_file)
+    logging.info(f"Time by stage: {METRICS.summary()}.")
+    if sampler is not None:
+        sampler.stop()
+        sampler.write(
+            os.path.splitext(metrics_file)[0].replace("_metrics", "") + "_profile.txt"
+        )
+    if not compact:
+        logging.info(f"New results flushed to {store.chunk_dir}.")
+        return None
+
     logging.info(
-        f"Processing complete. Final results saved to {output_file} and summary saved to {summary_file}."
+        f"Processing complete. Final results saved to {output_file} and summary saved to {store.summary_file}."
     )
 
-    return pd.DataFrame(all_scores), pd.DataFrame(summary_scores)
+    return all_scores, summary_scores
@@ -0,0 +1,131 @@
+import logging
+import multiprocessing
+import os
+import queue
+import sys
+
+import torch
+
+# Keep the parent single-threaded until the workers are forked. An OpenMP
+# thread pool started here would not survive the fork, and a child that
+# tried to use it could hang.
+torch.set_num_threads(1)
+
+import sentiment
+from worker import process_part
+
+# Intra-op threads (and pinned cores) per worker process. Inference scales
+# poorly past a few threads, so more workers with fewer threads each gets
+# more out of a node.
+THREADS_PER_WORKER = 4
+
+
+def core_sets(threads_per_worker, num_workers=None):
+    """Split the cores this process may run on into one set per worker.
+
+    Without `num_workers`, as many workers as there are full sets of
+    `threads_per_worker` cores (at least one).
+    """
+    cores = sorted(os.sched_getaffinity(0))
+    if num_workers is None:
+        num_workers = max(len(cores) // threads_per_worker, 1)
+
+    sets = []
+    for i in range(num_workers):
+        start = i * threads_per_worker % len(cores)
+        sets.append(set(cores[start : start + threads_per_worker]))
+    return sets
+
+
+def work_loop(tasks, results, year, cores):
+    """Pin to `cores`, then process parts from `tasks` until a None arrives."""
+    os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+    # ONNX Runtime sessions don't carry over a fork; build this worker's own
+    if sentiment.BACKEND.startswith("onnx"):
+        sentiment.get_backend.cache_clear()
+        sentiment.get_backend()
+
+    while True:
+        part_number = tasks.get()
+        if part_number is None:
+            break
+
+        try:
+            process_part(year, part_number)
+            results.put((part_number, None))
+        except Exception as e:
+            logging.exception(f"Part {part_number} failed.")
+            results.put((part_number, repr(e)))
+
+
+def run(year, part_numbers, threads_per_worker=THREADS_PER_WORKER, num_workers=None):
+    """Process parts in forked workers that share the already loaded model.
+
+    The model is loaded once in this process; the workers are forked from
+    it, so its weights are shared copy-on-write rather than loaded again in
+    each one. Returns {part_number: error or None}.
+    """
+    sentiment.warm_up()
+    context = multiprocessing.get_context("fork")
+    tasks = context.Queue()
+    results = context.Queue()
+
+    sets = core_sets(threads_per_worker, num_workers)
+    for part_number in part_numbers:
+        tasks.put(part_number)
+    for _ in sets:
+        tasks.put(None)
+
+    workers = [
+        context.Process(target=work_loop, args=(tasks, results, year, cores))
+        for cores in sets
+    ]
+    for worker in workers:
+        worker.start()
+    logging.info(
+        f"Started {len(workers)} workers with {threads_per_worker} threads each "
+        f"for {len(part_numbers)} parts."
+    )
+
+    outcomes = {}
+    while len(outcomes) < len(part_numbers):
+        try:
+            part_number, error = results.get(timeout=60)
+        except queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                logging.error("All workers exited before every part was processed.")
+                break
+            continue
+
+        outcomes[part_number] = error
+        status = "failed" if error else "done"
+        logging.info(
+            f"Part {part_number} {status} ({len(outcomes)}/{len(part_numbers)})."
+        )
+
+    for worker in workers:
+        worker.join()
+    return outcomes
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (4, 5):
+        print(
+            "Usage: python runner.py [year-range] [first_part] [last_part] "
+            "[threads_per_worker]"
+        )
+        sys.exit(-1)
+
+    year = sys.argv[1]
+    part_numbers = [str(i) for i in range(int(sys.argv[2]), int(sys.argv[3]) + 1)]
+    threads_per_worker = int(sys.argv[4]) if len(sys.argv) > 4 else THREADS_PER_WORKER
+
+    outcomes = run(year, part_numbers, threads_per_worker)
+    failed = [part for part in part_numbers if outcomes.get(part) is not None]
+    missing = [part for part in part_numbers if part not in outcomes]
+    if failed or missing:
+        print(f"Failed parts: {failed}. Unfinished parts: {missing}.")
+        sys.exit(1)
+    sys.exit(0)
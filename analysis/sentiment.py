@@ -1,45 +1,313 @@
+import logging
+from functools import lru_cache
+
 import numpy as np
-import torch
-from transformers import AutoModelForSequenceClassification, AutoTokenizer
-from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
 
-from utils import split_text_into_chunks
+from metrics import METRICS
+from utils import sigmoid, split_text_into_chunks
 
-tokenizer = AutoTokenizer.from_pretrained(
-    "SamLowe/roberta-base-go_emotions", clean_up_tokenization_spaces=True
-)
+MODEL_NAME = "SamLowe/roberta-base-go_emotions"
 
-model = AutoModelForSequenceClassification.from_pretrained(
-    "SamLowe/roberta-base-go_emotions",
-)
-labels = [model.config.id2label[i] for i in range(28)]
+# Which inference backend scores emotions; see backends.BACKENDS
+BACKEND = "torch"
 
-sia = SentimentIntensityAnalyzer()
+# The tokenizer, model, backend and VADER analyzer are created on first use,
+# so importing this module (or process.py) doesn't load torch or the model.
 
 
-def score_emotions(text_list):
-    try:
-        # Batch processing the text list
-        inputs = tokenizer(
-            text_list, padding=True, truncation=True, return_tensors="pt"
-        )
-        with torch.no_grad():
-            outputs = model(**inputs)
-            logits = outputs.logits  # Shape: (batch_size, num_labels)
-            # Apply sigmoid function and move logits back to CPU
-            scores = torch.sigmoid(logits).numpy()
+@lru_cache(maxsize=None)
+def get_tokenizer():
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(MODEL_NAME, clean_up_tokenization_spaces=True)
+
+
+@lru_cache(maxsize=None)
+def get_model():
+    from transformers import AutoModelForSequenceClassification
+
+    return AutoModelForSequenceClassification.from_pretrained(MODEL_NAME)
+
+
+@lru_cache(maxsize=None)
+def get_labels():
+    model = get_model()
+    return [model.config.id2label[i] for i in range(model.config.num_labels)]
+
+
+@lru_cache(maxsize=None)
+def get_backend():
+    from backends import load_backend
+
+    return load_backend(BACKEND, get_model())
+
+
+@lru_cache(maxsize=None)
+def get_analyzer():
+    from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
+
+    return SentimentIntensityAnalyzer()
+
 
-        return scores  # Return the array directly
+def warm_up():
+    """Load everything scoring needs now rather than on the first work.
 
+    Runs no inference, so it is safe to call before forking workers.
+    """
+    get_tokenizer()
+    get_labels()
+    get_backend()
+    get_analyzer()
+
+
+# Sentences per model forward pass at most
+BATCH_SIZE = 64
+
+# Padded tokens per forward pass at most (sentences x longest sentence), which
+# bounds activation memory however long the sentences run
+TOKEN_BUDGET = 8192
+
+
+def token_batches(lengths, max_tokens=TOKEN_BUDGET, max_batch=BATCH_SIZE):
+    """Group sentence indices into batches of similar token length.
+
+    Sentences are taken shortest first, so each batch pads to the length of
+    its last sentence, and a batch is closed before its padded size would go
+    over `max_tokens` or it would hold more than `max_batch` sentences. A
+    sentence longer than the budget on its own gets a batch to itself.
+    """
+    batches = []
+    batch = []
+    for index in np.argsort(lengths, kind="stable"):
+        padded_tokens = (len(batch) + 1) * lengths[index]
+        if batch and (padded_tokens > max_tokens or len(batch) >= max_batch):
+            batches.append(batch)
+            batch = []
+        batch.append(index)
+
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def score_emotions(text_list, max_tokens=TOKEN_BUDGET, max_batch=BATCH_SIZE):
+    """Emotion scores of each text, as an array of shape (len(text_list), num_labels).
+
+    Texts are tokenized once, then scored by `score_token_ids`.
+    """
+    num_labels = len(get_labels())
+    if len(text_list) == 0:
+        return np.empty((0, num_labels), dtype=np.float32)
+
+    try:
+        with METRICS.stage("tokenize"):
+            input_ids = get_tokenizer()(list(text_list), truncation=True)["input_ids"]
     except Exception as e:
         # In case of exception, return NaNs
-        num_chunks = len(text_list)
-        num_labels = len(labels)
-        return np.full((num_chunks, num_labels), np.nan)
+        return np.full((len(text_list), num_labels), np.nan)
+
+    return score_token_ids(input_ids, max_tokens, max_batch)
+
+
+def score_token_ids(input_ids, max_tokens=TOKEN_BUDGET, max_batch=BATCH_SIZE):
+    """Emotion scores of already tokenized sentences (special tokens included).
+
+    Sentences run through the model in length-bucketed batches (see
+    `token_batches`) and are put back in their original order. A batch that
+    fails comes back as NaNs.
+    """
+    num_labels = len(get_labels())
+    if len(input_ids) == 0:
+        return np.empty((0, num_labels), dtype=np.float32)
+
+    pad_token_id = get_tokenizer().pad_token_id
+    backend = get_backend()
+    lengths = [len(ids) for ids in input_ids]
+    METRICS.count("sentences", len(input_ids))
+    METRICS.count("tokens", sum(lengths))
+    scores = np.empty((len(input_ids), num_labels), dtype=np.float32)
+    for batch in token_batches(lengths, max_tokens, max_batch):
+        try:
+            # Right-pad to the longest sentence in this batch only
+            longest = lengths[batch[-1]]
+            batch_ids = np.full((len(batch), longest), pad_token_id, dtype=np.int64)
+            attention_mask = np.zeros((len(batch), longest), dtype=np.int64)
+            for row, index in enumerate(batch):
+                batch_ids[row, : lengths[index]] = input_ids[index]
+                attention_mask[row, : lengths[index]] = 1
+
+            with METRICS.stage("model"):
+                logits = backend.logits(batch_ids, attention_mask)
+            METRICS.count("padded_tokens", batch_ids.size)
+            scores[batch] = sigmoid(logits)
+
+        except Exception as e:
+            scores[batch] = np.nan
+
+    return scores
+
+
+# Largest difference from `get_emotion_scores` that batched scoring should
+# show on any label. Sentence scores only change through padding to a
+# different batch length, which moves float32 logits by around 1e-6.
+PARITY_TOLERANCE = 1e-4
+
+
+class EmotionBatcher:
+    """Pools the sentences of many windows into fixed-size model batches.
+
+    Windows can come from any number of works. `add` queues the sentences of
+    one window and returns its slot; `run` scores everything queued and
+    returns the mean score of each window's sentences, one row per slot,
+    the same means `get_emotion_scores` computes one window at a time.
+    `add_sentences` queues a window that is already split, as text or as
+    token IDs (see pretokenize.TokenizedWork).
+
+    With `unique_sentences`, a sentence that turns up in several windows
+    (overlapping percentile windows share most of theirs) is scored once
+    and its scores reused for every window it appears in. A `cache` dict
+    does the same across runs: sentences scored by an earlier `run` are
+    not sent to the model again.
+    """
+
+    def __init__(self, batch_size=BATCH_SIZE, unique_sentences=True, cache=None):
+        self.batch_size = batch_size
+        self.unique_sentences = unique_sentences
+        self.cache = cache
+        self.sentences = []
+        self.sentence_ids = {}
+        self.owners = []
+        self.rows = []
+        self.num_windows = 0
+        self.num_queued = 0
+
+    def add(self, text):
+        return self.add_sentences(split_text_into_chunks(text))
+
+    def add_sentences(self, sentences):
+        """Queue one window given as sentence strings or token ID tuples."""
+        slot = self.num_windows
+        for sentence in sentences:
+            if self.unique_sentences:
+                row = self.sentence_ids.get(sentence)
+                if row is None:
+                    row = self.sentence_ids[sentence] = len(self.sentences)
+                    self.sentences.append(sentence)
+            else:
+                row = len(self.sentences)
+                self.sentences.append(sentence)
+            self.rows.append(row)
+        self.owners.extend([slot] * len(sentences))
+        self.num_windows += 1
+        self.num_queued += len(sentences)
+        return slot
+
+    def run(self):
+        new = range(len(self.sentences))
+        if self.cache is not None:
+            new = [i for i in new if self.sentences[i] not in self.cache]
+
+        # Sentences queued as text are tokenized here, all in one call
+        texts = [i for i in new if isinstance(self.sentences[i], str)]
+        input_ids = list(self.sentences)
+        if texts:
+            with METRICS.stage("tokenize"):
+                tokenized = get_tokenizer()(
+                    [self.sentences[i] for i in texts], truncation=True
+                )["input_ids"]
+            for i, ids in zip(texts, tokenized):
+                input_ids[i] = ids
+
+        if self.cache is None:
+            scores = score_token_ids(input_ids, max_batch=self.batch_size)
+        else:
+            scores = np.empty((len(input_ids), len(get_labels())), dtype=np.float32)
+            scores[new] = score_token_ids(
+                [input_ids[i] for i in new], max_batch=self.batch_size
+            )
+            for i, sentence in enumerate(self.sentences):
+                scores[i] = self.cache.setdefault(sentence, scores[i])
+        owners = np.asarray(self.owners, dtype=np.int64)
+        rows = np.asarray(self.rows, dtype=np.int64)
+
+        sums = np.zeros((self.num_windows, len(get_labels())), dtype=np.float64)
+        np.add.at(sums, owners, scores[rows])
+        counts = np.bincount(owners, minlength=self.num_windows)
+        means = (sums / counts[:, None]).astype(np.float32)
+
+        METRICS.count("sentences_queued", self.num_queued)
+        logging.debug(
+            f"Scored {len(new)} unique of {self.num_queued} sentences "
+            f"for {self.num_windows} windows."
+        )
+        self.sentences = []
+        self.sentence_ids = {}
+        self.owners = []
+        self.rows = []
+        self.num_windows = 0
+        self.num_queued = 0
+        return means
+
+
+def score_columns(noOvTag=False):
+    """Names of the columns `score_windows` returns, VADER "pos" first."""
+    columns = ["pos"] + get_labels()
+    if noOvTag:
+        columns = [f"{column}_noOv" for column in columns]
+    return columns
+
+
+def score_windows(texts, batch_size=BATCH_SIZE, unique_sentences=True, pos=None):
+    """Scores of many windows as a float32 array of shape (len(texts), 1 + num_labels).
+
+    Column 0 is VADER's "pos", the rest the mean emotion scores of each
+    window's sentences; see `score_columns`. `pos` can bring the VADER
+    scores already worked out (see vader.WindowedVader); otherwise each
+    window goes through `polarity_scores`.
+    """
+    batcher = EmotionBatcher(batch_size, unique_sentences)
+    for text in texts:
+        batcher.add(text)
+
+    scores = np.empty((len(texts), 1 + len(get_labels())), dtype=np.float32)
+    scores[:, 1:] = batcher.run()
+    if pos is not None:
+        scores[:, 0] = pos
+        return scores
+
+    analyzer = get_analyzer()
+    for row, text in enumerate(texts):
+        scores[row, 0] = analyzer.polarity_scores(text)["pos"]
+    return scores
+
+
+def get_emotion_scores_batch(
+    texts, noOvTag=False, batch_size=BATCH_SIZE, unique_sentences=True
+):
+    """`get_emotion_scores` for many windows, sharing model batches across them."""
+    columns = score_columns(noOvTag)
+    scores = score_windows(texts, batch_size, unique_sentences)
+    return [dict(zip(columns, row)) for row in scores]
+
+
+def max_score_difference(texts, batch_size=BATCH_SIZE, unique_sentences=True):
+    """Largest per-label gap between batched and one-window-at-a-time scores.
+
+    Used to check `get_emotion_scores_batch` against `PARITY_TOLERANCE`.
+    """
+    batched = get_emotion_scores_batch(
+        texts, batch_size=batch_size, unique_sentences=unique_sentences
+    )
+    difference = 0.0
+    for text, batch_scores in zip(texts, batched):
+        for key, value in get_emotion_scores(text).items():
+            difference = max(difference, abs(float(value) - float(batch_scores[key])))
+    return difference
 
 
 def get_emotion_scores(text, noOvTag=False):
-    vader_scores = sia.polarity_scores(text)
+    labels = get_labels()
+    vader_scores = get_analyzer().polarity_scores(text)
     combined_scores = {"pos_noOv" if noOvTag else "pos": vader_scores["pos"]}
 
     text_chunks = split_text_into_chunks(text)
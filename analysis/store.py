@@ -0,0 +1,153 @@
+import glob
+import os
+import pickle
+import socket
+
+import numpy as np
+import pandas as pd
+
+from utils import create_open
+
+
+class ResultStore:
+    """Append-only result chunks and an index of finished works for one output.
+
+    `add` queues a work's percentile scores, a (percentiles x columns)
+    float32 array, and its summary row; `flush` writes everything queued
+    since the last flush as one new chunk, then appends the works' URLs to
+    the index, so a checkpoint only costs the new rows.
+    `compact` merges the chunks (and any earlier compacted output) into the
+    usual results and summary pickles.
+
+    Works written to a chunk but missing from the index (a crash in between)
+    are scored again, and `compact` keeps one copy of their rows.
+
+    Several workers can add to one store at once (see worker.process_queue):
+    chunk names carry the host and pid, and index lines are appended with
+    one write each. Only `compact` needs the store to itself.
+    """
+
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.summary_file = output_file.replace(".pkl", "_summary.pkl")
+        self.chunk_dir = output_file.replace(".pkl", "_chunks")
+        self.index_path = output_file.replace(".pkl", "_done.txt")
+
+        self.columns = None
+        self.blocks = []
+        self.summary = []
+        self.urls = []
+
+    def chunk_paths(self):
+        return sorted(glob.glob(os.path.join(self.chunk_dir, "chunk-*.pkl")))
+
+    def done_urls(self):
+        """URLs of every work already stored, read from the index alone."""
+        if not os.path.exists(self.index_path) and os.path.exists(self.output_file):
+            # Output from before the index existed: build it once
+            urls = pd.read_pickle(self.output_file)["url"].unique()
+            with create_open(self.index_path, "w") as file:
+                file.writelines(f"{url}\n" for url in urls)
+
+        urls = set()
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as file:
+                for line in file:
+                    # Skip a line cut short by a crash
+                    if line.endswith("\n"):
+                        urls.add(line[:-1])
+        return urls
+
+    def add(self, url, columns, scores, summary_row):
+        self.columns = columns
+        self.blocks.append(scores)
+        self.summary.append(summary_row)
+        self.urls.append(url)
+
+    def scores_frame(self):
+        """The queued percentile scores as one DataFrame, a column per emotion."""
+        lengths = [len(block) for block in self.blocks]
+        scores = np.concatenate(self.blocks)
+        frame = {
+            "url": np.repeat(np.array(self.urls, dtype=object), lengths),
+            "percentile": np.concatenate([np.arange(1, n + 1) for n in lengths]),
+        }
+        frame.update((column, scores[:, i]) for i, column in enumerate(self.columns))
+        return pd.DataFrame(frame)
+
+    def flush(self):
+        if not self.urls:
+            return
+
+        os.makedirs(self.chunk_dir, exist_ok=True)
+        paths = self.chunk_paths()
+        number = int(os.path.basename(paths[-1]).split("-")[1]) + 1 if paths else 0
+        # Host and pid keep apart the chunks of workers flushing at once
+        path = os.path.join(
+            self.chunk_dir,
+            f"chunk-{number:06d}-{socket.gethostname()}-{os.getpid()}.pkl",
+        )
+
+        # Written under a temporary name so a crash never leaves half a chunk
+        with open(path + ".partial", "wb") as file:
+            pickle.dump(
+                {"scores": self.scores_frame(), "summary": pd.DataFrame(self.summary)},
+                file,
+            )
+        os.replace(path + ".partial", path)
+
+        # A single append, so lines from other workers never land inside it
+        fd = os.open(self.index_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, "".join(f"{url}\n" for url in self.urls).encode())
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+        self.blocks = []
+        self.summary = []
+        self.urls = []
+
+    def compact(self):
+        """Merge all stored rows into the output pickles and drop the chunks.
+
+        Returns the (results, summary) DataFrames that were written.
+        """
+        self.flush()
+
+        scores = []
+        summary = []
+        if os.path.exists(self.output_file):
+            scores.append(pd.read_pickle(self.output_file))
+        if os.path.exists(self.summary_file):
+            summary.append(pd.read_pickle(self.summary_file))
+
+        paths = self.chunk_paths()
+        for path in paths:
+            with open(path, "rb") as file:
+                chunk = pickle.load(file)
+            scores.append(chunk["scores"])
+            summary.append(chunk["summary"])
+
+        scores_df = pd.concat(scores, ignore_index=True) if scores else pd.DataFrame()
+        summary_df = pd.concat(summary, ignore_index=True) if summary else pd.DataFrame()
+        if not scores_df.empty:
+            scores_df = scores_df.drop_duplicates(["url", "percentile"], keep="last")
+        if not summary_df.empty:
+            summary_df = summary_df.drop_duplicates("url", keep="last")
+
+        for df, path in [(scores_df, self.output_file), (summary_df, self.summary_file)]:
+            with create_open(path + ".partial", "wb") as file:
+                df.to_pickle(file)
+            os.replace(path + ".partial", path)
+
+        for path in paths:
+            os.remove(path)
+        try:
+            os.rmdir(self.chunk_dir)
+        except OSError:
+            # Missing, or a chunk was written after the merge began; the
+            # next compact picks it up
+            pass
+
+        return scores_df, summary_df
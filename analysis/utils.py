@@ -37,6 +37,10 @@ def split_text_into_chunks(text):
     return re.sub("<[^>]+>", "", str(text)).split(". ")
 
 
+def sigmoid(logits):
+    return 1 / (1 + np.exp(-logits))
+
+
 def smooth_scores(scores):
     scores = np.array(scores)
     if len(scores) == 0:
@@ -50,3 +54,17 @@ def smooth_scores(scores):
         smoothed_scores[0] = (scores[0] + scores[1]) / 2
         smoothed_scores[-1] = (scores[-2] + scores[-1]) / 2
         return smoothed_scores.tolist()
+
+
+def smooth_score_array(scores):
+    """`smooth_scores` applied to every column of a (percentiles x emotions) array."""
+    scores = np.asarray(scores, dtype=np.float64)
+    if len(scores) <= 1:
+        return scores
+
+    smoothed = np.empty_like(scores)
+    smoothed[1:-1] = (scores[:-2] + scores[1:-1] + scores[2:]) / 3
+    # Handle the edges separately
+    smoothed[0] = (scores[0] + scores[1]) / 2
+    smoothed[-1] = (scores[-2] + scores[-1]) / 2
+    return smoothed
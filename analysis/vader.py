@@ -0,0 +1,203 @@
+import string
+
+import numpy as np
+from vaderSentiment.vaderSentiment import BOOSTER_DICT
+
+# VADER looks at most this many tokens back and ahead of a word when it
+# scores it (negations and boosters behind, "no"/"kind of"/idioms ahead)
+LOOK_BEHIND = 3
+LOOK_AHEAD = 2
+
+# Largest difference from `polarity_scores(window)["pos"]` that
+# `WindowedVader.pos` may show. Every rule is applied with the same float
+# operations in the same order as polarity_scores, so the scores match
+# exactly; `max_pos_difference` checks that on real text.
+POS_TOLERANCE = 0.0
+
+
+class Context:
+    """The slice of tokens VADER's rules can see around one word."""
+
+    def __init__(self, words_and_emoticons, is_cap_diff):
+        self.words_and_emoticons = words_and_emoticons
+        self.is_cap_diff = is_cap_diff
+
+
+def strip_punc_if_word(token):
+    # As SentiText._strip_punc_if_word
+    stripped = token.strip(string.punctuation)
+    if len(stripped) <= 2:
+        return token
+    return stripped
+
+
+class WindowedVader:
+    """VADER "pos" scores for many windows over the words of one work.
+
+    `polarity_scores` re-tokenizes every window and runs each word's rules
+    over the whole window, so overlapping windows repeat that work many
+    times. Here the work is tokenized once and each lexicon word's valence
+    is worked out once from its few neighbours; a window only recomputes
+    the words at its edges, whose neighbours it cuts off, and sums the rest
+    from prefix sums.
+    """
+
+    def __init__(self, analyzer, words):
+        self.analyzer = analyzer
+
+        # Emojis are spelled out word by word, as polarity_scores does
+        tokens = []
+        bounds = [0]
+        exclamations = [0]
+        questions = [0]
+        for word in words:
+            if any(char in analyzer.emojis for char in word):
+                word = self.describe_emojis(word)
+            tokens.extend(strip_punc_if_word(token) for token in word.split())
+            bounds.append(len(tokens))
+            exclamations.append(exclamations[-1] + word.count("!"))
+            questions.append(questions[-1] + word.count("?"))
+
+        self.tokens = tokens
+        self.lower = [token.lower() for token in tokens]
+        self.bounds = np.array(bounds)
+        self.exclamations = np.array(exclamations)
+        self.questions = np.array(questions)
+
+        self.upper = np.concatenate(
+            [[0], np.cumsum([token.isupper() for token in tokens])]
+        )
+        self.buts = np.array(
+            [i for i, token in enumerate(self.lower) if token == "but"], dtype=np.int64
+        )
+        self.scored = [
+            i for i, token in enumerate(self.lower) if token in analyzer.lexicon
+        ]
+
+        # Valences with each word's full context, worked out per is_cap_diff
+        # value the first time a window needs it
+        self.valences = [None, None]
+        self.nonzero = [None, None]
+
+    def full_valences(self, is_cap_diff):
+        if self.valences[is_cap_diff] is None:
+            valences = np.zeros(len(self.tokens))
+            for i in self.scored:
+                valences[i] = self.valence(i, 0, len(self.tokens), is_cap_diff)
+            self.valences[is_cap_diff] = valences
+            # Positions of the words that carry any sentiment
+            self.nonzero[is_cap_diff] = np.flatnonzero(valences)
+        return self.valences[is_cap_diff], self.nonzero[is_cap_diff]
+
+    def describe_emojis(self, word):
+        # As the emoji loop in polarity_scores, for text that starts a word
+        described = ""
+        prev_space = True
+        for char in word:
+            if char in self.analyzer.emojis:
+                if not prev_space:
+                    described += " "
+                described += self.analyzer.emojis[char]
+                prev_space = False
+            else:
+                described += char
+                prev_space = char == " "
+        return described
+
+    def valence(self, i, start, end, is_cap_diff):
+        """Valence of token `i` in a window of tokens [start, end)."""
+        lower = self.lower[i]
+        if lower not in self.analyzer.lexicon or lower in BOOSTER_DICT:
+            return 0.0
+
+        context_start = max(start, i - LOOK_BEHIND)
+        context_end = min(end, i + LOOK_AHEAD + 1)
+        local = i - context_start
+        if (
+            lower == "kind"
+            and local < context_end - context_start - 1
+            and self.lower[i + 1] == "of"
+        ):
+            return 0.0
+
+        context = Context(self.tokens[context_start:context_end], bool(is_cap_diff))
+        return self.analyzer.sentiment_valence(0, context, self.tokens[i], local, [])[-1]
+
+    def pos(self, start_word, end_word):
+        """`polarity_scores(" ".join(words[start_word:end_word]))["pos"]`."""
+        start = self.bounds[start_word]
+        end = self.bounds[end_word]
+        num_tokens = end - start
+        if num_tokens == 0:
+            return 0.0
+
+        num_upper = self.upper[end] - self.upper[start]
+        is_cap_diff = int(0 < num_tokens - num_upper < num_tokens)
+
+        # The window's sentiments, with its edge words scored against only
+        # the neighbours the window keeps
+        valences, nonzero = self.full_valences(is_cap_diff)
+        positions = nonzero[np.searchsorted(nonzero, start) : np.searchsorted(nonzero, end)]
+        sentiments = dict(zip(positions.tolist(), valences[positions].tolist()))
+        edges = set(range(start, min(start + LOOK_BEHIND, end)))
+        edges.update(range(max(end - LOOK_AHEAD, start), end))
+        for i in edges:
+            sentiments[i] = self.valence(i, start, end, is_cap_diff)
+        positions = sorted(i for i, value in sentiments.items() if value != 0)
+        values = [sentiments[i] for i in positions]
+
+        # VADER's "but" rule, kept as written: it finds each sentiment by
+        # value, so an earlier, already scaled sentiment that happens to be
+        # equal gets scaled again instead
+        but = np.searchsorted(self.buts, start)
+        if but < len(self.buts) and self.buts[but] < end:
+            but = self.buts[but]
+            scaled = list(values)
+            for value in values:
+                j = scaled.index(value)
+                if positions[j] < but:
+                    scaled[j] = value * 0.5
+                elif positions[j] > but:
+                    scaled[j] = value * 1.5
+            values = scaled
+
+        # As _sift_sentiment_scores; the zeros only count as neutral
+        pos_sum = 0.0
+        neg_sum = 0.0
+        for value in values:
+            if value > 0:
+                pos_sum += float(value) + 1
+            else:
+                neg_sum += float(value) - 1
+        num_neutral = num_tokens - len(values)
+
+        # Punctuation emphasis, as score_valence
+        exclamations = min(self.exclamations[end_word] - self.exclamations[start_word], 4)
+        questions = self.questions[end_word] - self.questions[start_word]
+        amplifier = exclamations * 0.292
+        if questions > 1:
+            amplifier += questions * 0.18 if questions <= 3 else 0.96
+
+        if pos_sum > abs(neg_sum):
+            pos_sum += amplifier
+        elif pos_sum < abs(neg_sum):
+            neg_sum -= amplifier
+
+        total = pos_sum + abs(neg_sum) + num_neutral
+        return round(abs(pos_sum / total), 3)
+
+    def window_pos(self, ranges):
+        """`pos` of every (start_word, end_word) window in `ranges`."""
+        return [self.pos(start, end) for start, end in ranges]
+
+
+def max_pos_difference(analyzer, words, ranges):
+    """Largest gap between `WindowedVader.pos` and `polarity_scores` over windows."""
+    windowed = WindowedVader(analyzer, words).window_pos(ranges)
+    return max(
+        (
+            abs(analyzer.polarity_scores(" ".join(words[start:end]))["pos"] - pos)
+            for (start, end), pos in zip(ranges, windowed)
+        ),
+        default=0.0,
+    )
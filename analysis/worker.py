@@ -1,25 +1,113 @@
+import logging
 import sys
 
 import pandas as pd
 
+import sentiment
 from process import process_transcripts
+from store import ResultStore
+from workqueue import LeaseLost, WorkQueue, queue_path
 
-if __name__ == "__main__":
-    # Get the part number from command line arguments
-    if len(sys.argv) != 3:
-        print("Usage: python worker.py [year-range] [part_num]")
-        sys.exit(-1)
+SPLITS_DIR = "/scratch/tripakis.m/data-research/fanfic/splits"
 
-    year = sys.argv[1]
-    part_number = sys.argv[2]
 
+def part_path(year, part_number):
+    return f"{SPLITS_DIR}/{year}/fanfics_part_{part_number}.pkl"
+
+
+def result_path(year, part_number):
+    return f"results/{year}/result_part_{part_number}.pkl"
+
+
+def task_metrics_path(year, part_number, start_row):
+    return f"results/{year}/metrics/part_{part_number}_{start_row}_metrics.json"
+
+
+def process_part(year, part_number, adaptive_threshold=None):
     # Load the DataFrame part
-    df = pd.read_pickle(
-        f"/scratch/tripakis.m/data-research/fanfic/splits/{year}/fanfics_part_{part_number}.pkl"
-    )
+    df = pd.read_pickle(part_path(year, part_number))
 
     # Process the DataFrame
-    result_df = process_transcripts(
-        df, output_file=f"results/{year}/result_part_{part_number}.pkl"
+    return process_transcripts(
+        df,
+        output_file=result_path(year, part_number),
+        adaptive_threshold=adaptive_threshold,
     )
+
+
+def process_queue(year, adaptive_threshold=None):
+    """Claim batches of works from the period's queue until none are left.
+
+    Every batch of a part adds to the part's own results store
+    (results/{year}/result_part_{part}.pkl), which the worker that
+    finishes the part's last batch compacts. A batch whose lease ran out
+    (its worker was preempted) is picked up by another worker, which
+    resumes from the works already stored. Should the compacting worker
+    die, `python worker.py [year-range] [part_num]` compacts the part
+    without scoring anything again.
+    """
+    work_queue = WorkQueue(queue_path(year))
+    part_number, df = None, None
+
+    while True:
+        task = work_queue.claim(preferred_part=part_number)
+        if task is None:
+            break
+
+        task_id, task_part, start_row, end_row = task
+        if task_part != part_number:
+            # Tasks of the part already in memory are claimed first
+            part_number, df = task_part, pd.read_pickle(part_path(year, task_part))
+
+        try:
+            with work_queue.leased(task_id) as lease_lost:
+                process_transcripts(
+                    df.iloc[start_row:end_row],
+                    output_file=result_path(year, part_number),
+                    adaptive_threshold=adaptive_threshold,
+                    compact=False,
+                    metrics_file=task_metrics_path(year, part_number, start_row),
+                )
+        except Exception:
+            logging.exception(f"Task {task_id} (part {part_number}) failed.")
+            work_queue.release(task_id)
+            continue
+
+        if lease_lost.is_set():
+            # Another worker has the task now; what was stored here is
+            # deduplicated when the part is compacted
+            logging.warning(f"Task {task_id} was handed on; not completing it.")
+            continue
+
+        try:
+            part_done = work_queue.complete(task_id)
+        except LeaseLost:
+            logging.warning(f"Task {task_id} was handed on; not completing it.")
+            continue
+
+        logging.info(f"Task {task_id} done. Queue: {work_queue.counts()}")
+        if part_done:
+            ResultStore(result_path(year, part_number)).compact()
+            logging.info(f"Part {part_number} done and compacted.")
+
+
+if __name__ == "__main__":
+    # Get the part number from command line arguments. An adaptive
+    # threshold (e.g. 0.1) scores windows coarse-to-fine, for quick passes
+    if len(sys.argv) not in (3, 4):
+        print(
+            "Usage: python worker.py [year-range] [part_num | queue] "
+            "[adaptive_threshold]"
+        )
+        sys.exit(-1)
+
+    year = sys.argv[1]
+    part_number = sys.argv[2]
+    adaptive_threshold = float(sys.argv[3]) if len(sys.argv) > 3 else None
+
+    sentiment.warm_up()
+    if part_number == "queue":
+        process_queue(year, adaptive_threshold)
+    else:
+        result_df = process_part(year, part_number, adaptive_threshold)
     sys.exit(0)
@@ -0,0 +1,275 @@
+import contextlib
+import fcntl
+import glob
+import logging
+import os
+import re
+import socket
+import sqlite3
+import sys
+import threading
+import time
+
+import pandas as pd
+
+# A claimed task is handed to another worker if its lease runs out; the
+# owner renews it every LEASE_SECONDS / 3 while it works
+LEASE_SECONDS = 600
+
+# A task claimed this many times without finishing is left alone
+MAX_ATTEMPTS = 5
+
+# Queues live here, one per period. Every worker must see the same directory,
+# on a filesystem whose POSIX locks hold across nodes (SQLite relies on them
+# for claims): a local disk for a single node, or e.g. a /scratch mount with
+# coherent locking. NFS home directories are not safe; see `check_locking`.
+QUEUE_DIR = os.environ.get("ANALYSIS_QUEUE_DIR", "queues")
+
+# Filesystems whose locks SQLite can't rely on across nodes
+UNSAFE_FILESYSTEMS = {"nfs", "nfs4", "cifs", "smb3", "smbfs", "fuse.sshfs", "9p"}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    part TEXT NOT NULL,
+    start_row INTEGER NOT NULL,
+    end_row INTEGER NOT NULL,
+    owner TEXT,
+    lease_until REAL NOT NULL DEFAULT 0,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    done INTEGER NOT NULL DEFAULT 0
+)
+"""
+
+
+def queue_path(year):
+    return os.path.join(QUEUE_DIR, f"{year}.sqlite")
+
+
+def mount_of(path):
+    """(filesystem type, mount options) of the mount holding `path`.
+
+    Read from /proc/mounts; (None, []) where that isn't available.
+    """
+    path = os.path.realpath(path)
+    best_point, fs_type, options = "", None, []
+    try:
+        with open("/proc/mounts", "r") as file:
+            lines = file.readlines()
+    except OSError:
+        return None, []
+    for line in lines:
+        fields = line.split()
+        if len(fields) < 4:
+            continue
+        mount_point = fields[1].replace("\\040", " ")
+        inside = path == mount_point or path.startswith(mount_point.rstrip("/") + "/")
+        if inside and len(mount_point) > len(best_point):
+            best_point, fs_type, options = mount_point, fields[2], fields[3].split(",")
+    return fs_type, options
+
+
+def check_locking(directory):
+    """Raise if SQLite's locks in `directory` might not hold across workers.
+
+    Network filesystems like NFS are refused outright, as is Lustre unless
+    it is mounted with cluster-wide "flock"; then a lock must actually be
+    taken (NFS without a lock daemon fails here).
+    """
+    fs_type, options = mount_of(directory)
+    lustre_without_flock = fs_type == "lustre" and "flock" not in options
+    if fs_type in UNSAFE_FILESYSTEMS or lustre_without_flock:
+        raise RuntimeError(
+            f"{directory} is on {fs_type}, whose locks SQLite can't rely on; "
+            "set ANALYSIS_QUEUE_DIR to a directory on a filesystem with "
+            "working POSIX locks"
+        )
+    with open(os.path.join(directory, ".lock_check"), "w") as file:
+        try:
+            fcntl.lockf(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            fcntl.lockf(file, fcntl.LOCK_UN)
+        except OSError as e:
+            raise RuntimeError(f"Can't take POSIX locks in {directory}: {e}") from e
+
+
+class LeaseLost(Exception):
+    pass
+
+
+class WorkQueue:
+    """SQLite queue of small batches of works, claimed under renewable leases.
+
+    A task is a slice of rows [start_row, end_row) of one split part.
+    `claim` hands out the first task that is neither done nor leased; a
+    worker that dies stops renewing, and its task goes back to the pool
+    once the lease runs out.
+
+    Claims rely on SQLite's file locks, so the database must be on a
+    filesystem where they work for every worker (see QUEUE_DIR); that is
+    checked on opening.
+    """
+
+    def __init__(self, path, lease_seconds=LEASE_SECONDS):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        check_locking(os.path.dirname(path) or ".")
+        # Shared with the lease renewal thread; `lock` keeps their use apart
+        self.connection = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.connection.execute(SCHEMA)
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.connection
+            except BaseException:
+                self.connection.execute("ROLLBACK")
+                raise
+            self.connection.execute("COMMIT")
+
+    def add_part(self, part, num_rows, works_per_task):
+        with self.transaction() as connection:
+            if connection.execute(
+                "SELECT 1 FROM tasks WHERE part = ? LIMIT 1", (part,)
+            ).fetchone():
+                return 0
+            connection.executemany(
+                "INSERT INTO tasks (part, start_row, end_row) VALUES (?, ?, ?)",
+                [
+                    (part, start, min(start + works_per_task, num_rows))
+                    for start in range(0, num_rows, works_per_task)
+                ],
+            )
+        return -(-num_rows // works_per_task)
+
+    def claim(self, preferred_part=None):
+        """Lease the next open task, from `preferred_part` if it has one.
+
+        Returns (id, part, start_row, end_row), or None when nothing is open.
+        """
+        now = time.time()
+        with self.transaction() as connection:
+            task = connection.execute(
+                "SELECT id, part, start_row, end_row FROM tasks "
+                "WHERE done = 0 AND lease_until < ? AND attempts < ? "
+                "ORDER BY part = ? DESC, id LIMIT 1",
+                (now, MAX_ATTEMPTS, preferred_part),
+            ).fetchone()
+            if task is None:
+                return None
+            connection.execute(
+                "UPDATE tasks SET owner = ?, lease_until = ?, attempts = attempts + 1 "
+                "WHERE id = ?",
+                (self.owner, now + self.lease_seconds, task[0]),
+            )
+        return task
+
+    def renew(self, task_id):
+        """Extend the lease; False if the task was handed to another worker."""
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE tasks SET lease_until = ? "
+                "WHERE id = ? AND owner = ? AND done = 0",
+                (time.time() + self.lease_seconds, task_id, self.owner),
+            )
+        return cursor.rowcount > 0
+
+    def complete(self, task_id):
+        """Mark a task done. Returns whether it was the last open task of its part.
+
+        Raises LeaseLost if the task is no longer ours.
+        """
+        with self.transaction() as connection:
+            cursor = connection.execute(
+                "UPDATE tasks SET done = 1, lease_until = 0 "
+                "WHERE id = ? AND owner = ? AND done = 0",
+                (task_id, self.owner),
+            )
+            if cursor.rowcount == 0:
+                raise LeaseLost(f"Task {task_id} is no longer leased to {self.owner}")
+            (remaining,) = connection.execute(
+                "SELECT COUNT(*) FROM tasks WHERE done = 0 AND part = "
+                "(SELECT part FROM tasks WHERE id = ?)",
+                (task_id,),
+            ).fetchone()
+        return remaining == 0
+
+    def release(self, task_id):
+        """Give a task back straight away, e.g. after it failed."""
+        with self.transaction() as connection:
+            connection.execute(
+                "UPDATE tasks SET lease_until = 0 WHERE id = ? AND owner = ?",
+                (task_id, self.owner),
+            )
+
+    @contextlib.contextmanager
+    def leased(self, task_id):
+        """Keep renewing `task_id`'s lease in the background while in the block.
+
+        Yields an Event that is set if the lease was lost, i.e. the task was
+        given to another worker after a renewal came too late.
+        """
+        stop = threading.Event()
+        lost = threading.Event()
+
+        def keep_alive():
+            while not stop.wait(self.lease_seconds / 3):
+                try:
+                    if not self.renew(task_id):
+                        logging.warning(f"Lost the lease on task {task_id}.")
+                        lost.set()
+                        return
+                except sqlite3.Error:
+                    # E.g. the database stayed locked; try again next time
+                    logging.exception(f"Could not renew the lease on task {task_id}.")
+
+        thread = threading.Thread(target=keep_alive, daemon=True)
+        thread.start()
+        try:
+            yield lost
+        finally:
+            stop.set()
+            thread.join()
+
+    def counts(self):
+        now = time.time()
+        done, leased, failed, total = self.connection.execute(
+            "SELECT SUM(done = 1), SUM(done = 0 AND lease_until >= ?), "
+            "SUM(done = 0 AND attempts >= ?), COUNT(*) FROM tasks",
+            (now, MAX_ATTEMPTS),
+        ).fetchone()
+        return {
+            "done": done or 0,
+            "leased": leased or 0,
+            "failed": failed or 0,
+            "total": total,
+        }
+
+
+if __name__ == "__main__":
+    # Usage: python workqueue.py [year-range] [works_per_task]
+    # Queues every split part of a period in batches of `works_per_task`
+    # works, in ANALYSIS_QUEUE_DIR (default "queues"), which every worker
+    # must share. Parts already queued are left as they are, so new parts
+    # can be added later. Then run: python worker.py [year-range] queue
+    if len(sys.argv) not in (2, 3):
+        print("Usage: python workqueue.py [year-range] [works_per_task]")
+        sys.exit(-1)
+
+    from worker import SPLITS_DIR
+
+    year = sys.argv[1]
+    works_per_task = int(sys.argv[2]) if len(sys.argv) > 2 else 25
+
+    work_queue = WorkQueue(queue_path(year))
+    for path in sorted(glob.glob(f"{SPLITS_DIR}/{year}/fanfics_part_*.pkl")):
+        part = re.search(r"fanfics_part_(\w+)\.pkl$", path).group(1)
+        num_tasks = work_queue.add_part(part, len(pd.read_pickle(path)), works_per_task)
+        print(f"Part {part}: {num_tasks} tasks queued")
+    print(f"Queue {work_queue.path}: {work_queue.counts()}")
@@ -0,0 +1,201 @@
+import os
+import re
+import threading
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+def load_fixture(name):
+    with open(os.path.join(FIXTURES, name), "r", encoding="utf-8") as file:
+        return file.read()
+
+
+def fill(template, **values):
+    # str.format would trip over braces in real page markup
+    for key, value in values.items():
+        template = template.replace("{" + key + "}", str(value))
+    return template
+
+
+def work_kind(work_id):
+    """Which fixture a work id is served from, fixed so runs are comparable."""
+    bucket = work_id % 10
+    if bucket == 0:
+        return "empty"
+    if bucket == 9:
+        return "missing"
+    if bucket in (1, 2, 3):
+        return "multi_chapter"
+    return "oneshot"
+
+
+class StandInAO3(ThreadingHTTPServer):
+    """Local HTTP server that answers AO3 search and work URLs from fixtures.
+
+    Search page `p` lists `works_per_page` works with ids p * 1000 + i. Work
+    pages are multi-chapter, one-shot, empty (no chapter text) or 404s
+    depending on the id. Every `error_every`-th work request gets the
+    "Retry later" page with a 429, so retry paths are exercised too.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        num_pages=10,
+        works_per_page=20,
+        paragraphs_per_chapter=40,
+        chapters=3,
+        error_every=0,
+    ):
+        super().__init__(("127.0.0.1", 0), StandInHandler)
+        self.num_pages = num_pages
+        self.works_per_page = works_per_page
+        self.paragraphs_per_chapter = paragraphs_per_chapter
+        self.chapters = chapters
+        self.error_every = error_every
+
+        self.templates = {
+            name: load_fixture(name + ".html")
+            for name in [
+                "search",
+                "blurb",
+                "work",
+                "chapter",
+                "paragraphs",
+                "retry_later",
+                "not_found",
+            ]
+        }
+        self.paragraphs = self.templates["paragraphs"].strip().split("\n")
+        self.num_requests = 0
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def search_query(self):
+        return self.base_url + "/works/search?work_search%5Bquery%5D=stand-in"
+
+    def work_stats(self, work_id):
+        kind = work_kind(work_id)
+        num_chapters = self.chapters if kind == "multi_chapter" else 1
+        words = num_chapters * self.paragraphs_per_chapter * 45
+        revised = date(2024, 1, 1) + timedelta(days=work_id % 365)
+        return num_chapters, words, revised
+
+    def search_page(self, page):
+        blurbs = []
+        # Pages past the last one list no works, as on the real site
+        works_on_page = self.works_per_page if page <= self.num_pages else 0
+        for i in range(works_on_page):
+            work_id = page * 1000 + i
+            num_chapters, words, revised = self.work_stats(work_id)
+            blurbs.append(
+                fill(
+                    self.templates["blurb"],
+                    work_id=work_id,
+                    revised=revised.strftime("%d %b %Y"),
+                    words=f"{words:,}",
+                    chapters=f'<a href="/works/{work_id}/chapters/1">'
+                    f"{num_chapters}</a>/{num_chapters}",
+                )
+            )
+        return fill(
+            self.templates["search"],
+            found=f"{self.num_pages * self.works_per_page:,}",
+            num_pages=self.num_pages,
+            blurbs="\n".join(blurbs),
+        )
+
+    def work_page(self, work_id):
+        kind = work_kind(work_id)
+        num_chapters, words, revised = self.work_stats(work_id)
+
+        chapters_html = ""
+        if kind != "empty":
+            for number in range(1, num_chapters + 1):
+                paragraphs = [
+                    self.paragraphs[(work_id + number + i) % len(self.paragraphs)]
+                    for i in range(self.paragraphs_per_chapter)
+                ]
+                chapters_html += fill(
+                    self.templates["chapter"],
+                    work_id=work_id,
+                    number=number,
+                    paragraphs="\n".join(paragraphs),
+                )
+
+        updated = ""
+        if num_chapters > 1:
+            updated = (
+                '<dt class="status">Completed:</dt>'
+                f'<dd class="status">{revised.isoformat()}</dd>'
+            )
+        return fill(
+            self.templates["work"],
+            work_id=work_id,
+            updated=updated,
+            words=f"{words:,}",
+            chapters=f"{num_chapters}/{num_chapters}",
+            chapters_html=chapters_html,
+        )
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes; avoid delayed-ACK stalls
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_html(self, status, html, headers=None):
+        body = html.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+
+        if url.path == "/works/search":
+            page = int(parse_qs(url.query).get("page", ["1"])[0])
+            self.send_html(200, server.search_page(page))
+            return
+
+        match = re.fullmatch(r"/works/(\d+)", url.path)
+        if match is None:
+            self.send_html(404, server.templates["not_found"])
+            return
+
+        with server.lock:
+            server.num_requests += 1
+            throttle = (
+                server.error_every and server.num_requests % server.error_every == 0
+            )
+        if throttle:
+            self.send_html(429, server.templates["retry_later"], {"Retry-After": "0"})
+            return
+
+        work_id = int(match.group(1))
+        if work_kind(work_id) == "missing":
+            self.send_html(404, server.templates["not_found"])
+            return
+        self.send_html(200, server.work_page(work_id))
+
+
+def start_server(**kwargs):
+    """Start a stand-in server on a free port in a background thread."""
+    server = StandInAO3(**kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
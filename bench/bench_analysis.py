@@ -0,0 +1,462 @@
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), "analysis"))
+
+import load
+import sentiment
+import vader
+from metrics import METRICS, peak_rss_mb
+from pretokenize import token_mismatches
+from process import (
+    ADAPTIVE_THRESHOLD,
+    MAX_WORDS,
+    process_transcripts,
+    split_words_into_percentiles,
+)
+
+BASELINE_PATH = os.path.join(BENCH_DIR, "baselines", "analysis.json")
+
+# A run fails its check when a rate drops, or peak memory grows, by more
+# than this fraction of the baseline
+TOLERANCE = 0.2
+
+# Works the exact-parity checks run on, and every how many of their windows
+# the model is compared one window at a time (the slow reference)
+PARITY_WORKS = 4
+PARITY_WINDOW_STEP = 10
+
+# Sentences mixed into the synthetic works now and then: dialogue,
+# abbreviations and punctuation that VADER and the sentence splitter react to
+SENTENCES = [
+    "She laughed and hugged him, happier than she had been in years.",
+    "He was furious, and the door slammed hard behind him!",
+    '"I miss you," she whispered, tears running down her face.',
+    "Mr. Potter did not answer the letter.",
+    "It was awful... truly, horribly awful.",
+    "WHAT were you thinking?! he shouted.",
+    "The cake was delicious and everyone loved it 😀.",
+]
+
+# The rest of the text is drawn word by word from a large vocabulary of
+# made-up words, with VADER lexicon words for the emotional stretches, so
+# nearly every sentence is distinct as in real fiction and deduplicating
+# sentences saves no more than it would there
+VOCABULARY_SIZE = 20000
+COMMON_WORDS = (
+    "the and to of a she he was her his in it that you i had not with for at "
+    "but on they as said be him my all so me we what there no would were"
+).split()
+SYLLABLES = [c + v for c in "bdfghklmnprstvwz" for v in "aeiou"] + ["an", "el", "or"]
+
+# The stand-in classifier: a small randomly initialised RoBERTa with the
+# model's labels, built offline and the same on every run. It is big enough
+# that scoring takes most of the time, as with the real model, and its
+# weights are drawn wider than usual so its scores vary with the text.
+STAND_IN_LABELS = 28
+STAND_IN_VOCAB = 8000
+STAND_IN_INIT_RANGE = 0.2
+
+
+def made_up_words(rng, size=VOCABULARY_SIZE):
+    """COMMON_WORDS, then made-up words in random order, `size` in all."""
+    words = set(COMMON_WORDS)
+    while len(words) < size:
+        words.add("".join(rng.choice(SYLLABLES, size=rng.integers(1, 5))))
+    made_up = sorted(words - set(COMMON_WORDS))
+    return COMMON_WORDS + rng.permutation(made_up).tolist()
+
+
+def synthetic_corpus(num_works, seed=0):
+    """Works with a long-tailed length distribution like the scraped collections.
+
+    Lengths are log-normal around a few thousand words; about one work in
+    twenty has no text, and two are over MAX_WORDS. Each work is a run of
+    stretches, each neutral, happy or sad, of sentences drawn from a
+    Zipf-like vocabulary, with a SENTENCES line now and then.
+    """
+    rng = np.random.default_rng(seed)
+    lengths = np.exp(rng.normal(np.log(3000), 1.0, num_works)).astype(int)
+    lengths[rng.random(num_works) < 0.05] = 0
+    lengths[rng.choice(num_works, size=min(2, num_works), replace=False)] = (
+        MAX_WORDS + 10000
+    )
+
+    vocabulary = np.array(made_up_words(rng), dtype=object)
+    # Zipf-like word frequencies, drawn through the cumulative distribution
+    cumulative = np.cumsum(1 / np.arange(10, len(vocabulary) + 10))
+    cumulative /= cumulative[-1]
+    lexicon = sentiment.get_analyzer().lexicon
+    moods = {
+        1: np.array(sorted(w for w, v in lexicon.items() if v >= 1 and w.isalpha())),
+        -1: np.array(sorted(w for w, v in lexicon.items() if v <= -1 and w.isalpha())),
+    }
+
+    texts = []
+    for length in lengths:
+        picked = []
+        words = 0
+        while words < length:
+            mood = rng.choice([-1, 0, 1])
+            for _ in range(rng.integers(5, 60)):
+                if rng.random() < 0.05:
+                    sentence = SENTENCES[rng.integers(len(SENTENCES))]
+                    picked.append(sentence)
+                    words += len(sentence.split())
+                    continue
+
+                draws = rng.random(rng.integers(6, 25))
+                sentence = vocabulary[np.searchsorted(cumulative, draws)]
+                if mood:
+                    emotional = rng.random(len(sentence)) < 0.15
+                    sentence[emotional] = rng.choice(moods[mood], emotional.sum())
+                picked.append(
+                    " ".join(sentence).capitalize() + rng.choice([".", ".", "!", "?"])
+                )
+                words += len(sentence)
+        texts.append(" ".join(picked) if picked else "")
+
+    return pd.DataFrame(
+        {
+            "url": [f"https://archiveofourown.org/works/{i}" for i in range(num_works)],
+            "title": [f"Work {i}" for i in range(num_works)],
+            "text": texts,
+        }
+    )
+
+
+def build_stand_in(model_dir, texts, seed=0):
+    """Save a tokenizer trained on `texts` and a tiny classifier to `model_dir`."""
+    import torch
+    from tokenizers import ByteLevelBPETokenizer
+    from transformers import (
+        RobertaConfig,
+        RobertaForSequenceClassification,
+        RobertaTokenizerFast,
+    )
+
+    bpe = ByteLevelBPETokenizer()
+    bpe.train_from_iterator(
+        texts,
+        vocab_size=STAND_IN_VOCAB,
+        min_frequency=1,
+        special_tokens=["<s>", "<pad>", "</s>", "<unk>", "<mask>"],
+        show_progress=False,
+    )
+    os.makedirs(model_dir, exist_ok=True)
+    vocab_file, merges_file = bpe.save_model(model_dir)
+    tokenizer = RobertaTokenizerFast(vocab_file, merges_file, model_max_length=512)
+    tokenizer.save_pretrained(model_dir)
+
+    torch.manual_seed(seed)
+    config = RobertaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=256,
+        num_hidden_layers=4,
+        num_attention_heads=4,
+        intermediate_size=1024,
+        max_position_embeddings=514,
+        type_vocab_size=1,
+        pad_token_id=tokenizer.pad_token_id,
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        initializer_range=STAND_IN_INIT_RANGE,
+        num_labels=STAND_IN_LABELS,
+        problem_type="multi_label_classification",
+    )
+    RobertaForSequenceClassification(config).save_pretrained(model_dir)
+    return model_dir
+
+
+def use_model(model_name):
+    sentiment.MODEL_NAME = model_name
+    for getter in [
+        sentiment.get_tokenizer,
+        sentiment.get_model,
+        sentiment.get_labels,
+        sentiment.get_backend,
+    ]:
+        getter.cache_clear()
+    sentiment.warm_up()
+
+
+def bench_split(df, work_dir, num_splits=4):
+    """load.split_and_save over the corpus written as two Parquet tables."""
+    scraped_dir = os.path.join(work_dir, "scraped")
+    os.makedirs(scraped_dir)
+    half = len(df) // 2
+    df.iloc[:half].to_parquet(os.path.join(scraped_dir, "a.parquet"))
+    df.iloc[half:].to_parquet(os.path.join(scraped_dir, "b.parquet"))
+
+    split_dir = os.path.join(work_dir, "splits")
+    start = time.perf_counter()
+    load.split_and_save(scraped_dir, split_dir, num_splits=num_splits)
+    elapsed = time.perf_counter() - start
+    return {"seconds": elapsed, "works_per_sec": len(df) / elapsed}
+
+
+def bench_process(df, work_dir):
+    """process_transcripts over the corpus, with its stage metrics."""
+    output_file = os.path.join(work_dir, "results", "result_part_0.pkl")
+    start = time.perf_counter()
+    scores, summary = process_transcripts(df, output_file)
+    elapsed = time.perf_counter() - start
+
+    report = METRICS.report()
+    stages = report["stages"]
+    checkpoint = stages.get("checkpoint", {}).get("seconds", 0.0)
+    return {
+        "seconds": elapsed,
+        "works": len(summary),
+        "works_per_sec": len(summary) / elapsed,
+        "windows_per_sec": report["counters"]["windows"] / elapsed,
+        "sentences_per_sec": report["rates"]["sentences_per_second"],
+        "checkpoint_seconds": checkpoint,
+        "checkpoint_share": checkpoint / elapsed,
+        "stages": {name: stage["seconds"] for name, stage in stages.items()},
+        "tokens": report["counters"]["tokens"],
+        # Sum of every score, to catch changes in what is computed
+        "score_sum": float(summary.drop(columns="url").to_numpy().sum()),
+    }
+
+
+def bench_adaptive(df, work_dir):
+    """process_transcripts with ADAPTIVE_THRESHOLD, against the full run's output.
+
+    Runs after bench_process, whose scores it compares to. The model work
+    is counted in tokens scored.
+    """
+    results_dir = os.path.join(work_dir, "results")
+    output_file = os.path.join(results_dir, "result_part_0_adaptive.pkl")
+    start = time.perf_counter()
+    scores, summary = process_transcripts(
+        df, output_file, adaptive_threshold=ADAPTIVE_THRESHOLD
+    )
+    elapsed = time.perf_counter() - start
+    tokens = METRICS.report()["counters"]["tokens"]
+
+    full = pd.read_pickle(os.path.join(results_dir, "result_part_0.pkl"))
+    key = ["url", "percentile"]
+    full = full.sort_values(key).reset_index(drop=True)
+    scores = scores.sort_values(key).reset_index(drop=True)
+    columns = [column for column in full.columns if column not in key]
+    return {
+        "seconds": elapsed,
+        "works_per_sec": len(summary) / elapsed,
+        "windows_scored_share": float(summary["windows_scored"].sum() / len(full)),
+        "tokens": tokens,
+        "max_error": float(
+            np.abs(full[columns].to_numpy() - scores[columns].to_numpy()).max()
+        ),
+    }
+
+
+def bench_parity(df):
+    """The exact-parity helpers of the fast paths, on the windows of a few works.
+
+    Each value is the largest difference from the straightforward
+    computation the fast path replaces.
+    """
+    texts = [text for text in df["text"] if text][:PARITY_WORKS]
+    pos_difference = 0.0
+    mismatches = 0
+    windows = []
+    for text in texts:
+        words, ranges = split_words_into_percentiles(text)
+        pos_difference = max(
+            pos_difference,
+            vader.max_pos_difference(sentiment.get_analyzer(), words, ranges),
+        )
+        mismatches += token_mismatches(sentiment.get_tokenizer(), words, ranges)
+        windows += [
+            " ".join(words[start:end])
+            for start, end in ranges[::PARITY_WINDOW_STEP]
+        ]
+    return {
+        "vader_pos_difference": pos_difference,
+        "token_mismatches": mismatches,
+        "score_difference": sentiment.max_score_difference(windows),
+    }
+
+
+def bench_emotion_scores(df, num_windows=20, window_size=500, repeats=3):
+    """get_emotion_scores, one window at a time as the original pipeline ran.
+
+    The fastest of `repeats` passes counts, as the pass is short.
+    """
+    words = max(df["text"], key=len).split()
+    windows = [
+        " ".join(words[i * window_size : (i + 1) * window_size])
+        for i in range(num_windows)
+    ]
+    elapsed = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for window in windows:
+            sentiment.get_emotion_scores(window)
+        elapsed = min(elapsed, time.perf_counter() - start)
+    return {"seconds": elapsed, "windows_per_sec": num_windows / elapsed}
+
+
+def run(num_works=40, model_name=None):
+    logging.getLogger().setLevel(logging.WARNING)
+    df = synthetic_corpus(num_works)
+    report = {
+        "num_works": num_works,
+        "num_words": int(df["text"].str.split().str.len().sum()),
+        "model": model_name or "stand-in",
+    }
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        use_model(
+            model_name
+            or build_stand_in(os.path.join(work_dir, "model"), df["text"])
+        )
+
+        report["split"] = bench_split(df, work_dir)
+        print(f"split_and_save: {report['split']['works_per_sec']:.1f} works/s")
+
+        report["process"] = bench_process(df, work_dir)
+        print(
+            f"process_transcripts: {report['process']['works_per_sec']:.2f} works/s, "
+            f"{report['process']['windows_per_sec']:.1f} windows/s, "
+            f"checkpoints {report['process']['checkpoint_share']:.1%} of the time"
+        )
+
+        report["adaptive"] = bench_adaptive(df, work_dir)
+        print(
+            f"adaptive: {report['adaptive']['works_per_sec']:.2f} works/s, "
+            f"{report['adaptive']['windows_scored_share']:.0%} of windows and "
+            f"{report['adaptive']['tokens'] / report['process']['tokens']:.0%} "
+            f"of tokens scored, max error {report['adaptive']['max_error']:.4f}"
+        )
+
+        report["parity"] = bench_parity(df)
+        print(
+            f"parity: VADER pos {report['parity']['vader_pos_difference']:.2g}, "
+            f"{report['parity']['token_mismatches']} token mismatches, "
+            f"scores {report['parity']['score_difference']:.2g}"
+        )
+
+        report["get_emotion_scores"] = bench_emotion_scores(df)
+        print(
+            f"get_emotion_scores: "
+            f"{report['get_emotion_scores']['windows_per_sec']:.1f} windows/s"
+        )
+
+    report["peak_rss_mb"] = peak_rss_mb()
+    print(f"Peak RSS: {report['peak_rss_mb']:.1f} MB")
+    return report
+
+
+def parity_problems(report):
+    """Where the fast paths stray from the computation they replace, as messages."""
+    problems = []
+    parity = report["parity"]
+    if parity["vader_pos_difference"] > vader.POS_TOLERANCE:
+        problems.append(
+            f"VADER pos differs by {parity['vader_pos_difference']:.2g} "
+            f"> {vader.POS_TOLERANCE}"
+        )
+    if parity["token_mismatches"]:
+        problems.append(f"{parity['token_mismatches']} windows tokenize differently")
+    if parity["score_difference"] > sentiment.PARITY_TOLERANCE:
+        problems.append(
+            f"batched scores differ by {parity['score_difference']:.2g} "
+            f"> {sentiment.PARITY_TOLERANCE}"
+        )
+    if report["adaptive"]["tokens"] > report["process"]["tokens"]:
+        problems.append(
+            f"adaptive mode scored {report['adaptive']['tokens']} tokens, "
+            f"more than the {report['process']['tokens']} of a full run"
+        )
+    return problems
+
+
+def regressions(report, baseline, tolerance=TOLERANCE):
+    """What got worse than `baseline` by more than `tolerance`, as messages."""
+    if (report["num_works"], report["model"]) != (
+        baseline["num_works"],
+        baseline["model"],
+    ):
+        return ["baseline was run on a different corpus or model"]
+
+    problems = []
+    for section, key in [
+        ("split", "works_per_sec"),
+        ("process", "works_per_sec"),
+        ("process", "windows_per_sec"),
+        ("adaptive", "works_per_sec"),
+        ("get_emotion_scores", "windows_per_sec"),
+    ]:
+        value, expected = report[section][key], baseline[section][key]
+        if value < expected * (1 - tolerance):
+            problems.append(f"{section} {key}: {value:.2f} < {expected:.2f}")
+
+    if report["peak_rss_mb"] > baseline["peak_rss_mb"] * (1 + tolerance):
+        problems.append(
+            f"peak_rss_mb: {report['peak_rss_mb']:.0f} > {baseline['peak_rss_mb']:.0f}"
+        )
+
+    score_sum = report["process"]["score_sum"]
+    expected = baseline["process"]["score_sum"]
+    if abs(score_sum - expected) > 1e-3 * max(1.0, abs(expected)):
+        problems.append(f"scores changed: sum {score_sum:.4f} != {expected:.4f}")
+
+    # Interpolation error has no fixed bound; it may only drift a little
+    max_error = report["adaptive"]["max_error"]
+    expected = baseline["adaptive"]["max_error"]
+    if max_error > expected * (1 + tolerance) + 1e-3:
+        problems.append(f"adaptive max error: {max_error:.4f} > {expected:.4f}")
+    return problems
+
+
+if __name__ == "__main__":
+    # Usage: python bench/bench_analysis.py [check | baseline] [num_works] [model]
+    # "baseline" stores this run's numbers in bench/baselines/analysis.json;
+    # "check" also checks the fast paths against their reference results and
+    # compares the run against the baseline; it exits with 1 on a problem.
+    # Without a model (a local snapshot directory), a small stand-in
+    # classifier is built, so no download is needed.
+    if len(sys.argv) < 2 or sys.argv[1] not in ("check", "baseline"):
+        print(
+            "Usage: python bench/bench_analysis.py [check | baseline] "
+            "[num_works] [model]"
+        )
+        sys.exit(-1)
+
+    mode = sys.argv[1]
+    num_works = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    model_name = sys.argv[3] if len(sys.argv) > 3 else None
+    report = run(num_works, model_name)
+
+    if mode == "baseline":
+        os.makedirs(os.path.dirname(BASELINE_PATH), exist_ok=True)
+        with open(BASELINE_PATH, "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Baseline saved to {BASELINE_PATH}")
+        sys.exit(0)
+
+    problems = parity_problems(report)
+    for problem in problems:
+        print(f"Parity: {problem}")
+
+    if not os.path.exists(BASELINE_PATH):
+        print(f"No baseline at {BASELINE_PATH}; run with 'baseline' first.")
+        sys.exit(1 if problems else -1)
+    with open(BASELINE_PATH, "r") as file:
+        baseline = json.load(file)
+    regressed = regressions(report, baseline)
+    for problem in regressed:
+        print(f"Regression: {problem}")
+    if problems or regressed:
+        sys.exit(1)
+    print("No regressions against the baseline.")
@@ -0,0 +1,142 @@
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ao3_server import start_server
+from rate_limiter import RateLimiter
+from scrape import (
+    FULL_WORK_SUFFIX,
+    HttpFetcher,
+    ProxyPool,
+    make_csv,
+    parse_work,
+    scrape_all_pages,
+    scrape_all_pages_concurrent,
+    scrape_page,
+)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def unthrottled_pool(num_proxies):
+    """A pool of direct connections whose limiters never hold back a request.
+
+    The rate is pinned: the server's injected 429s would otherwise halve it
+    down to a few requests a second, and the bench would time the backoff
+    instead of the crawl. They still pass through the limiter and the retry
+    path (the server sends Retry-After: 0).
+    """
+    pool = ProxyPool([(None, None)] * num_proxies, cooldown=1)
+    pool.limiters = [
+        RateLimiter(
+            rate=10000, min_rate=10000, max_rate=10000, burst=100, base_backoff=0.01
+        )
+        for _ in range(num_proxies)
+    ]
+    return pool
+
+
+def bench_parse(server, repeats=20):
+    """Seconds to parse one work page of each kind, averaged over `repeats`."""
+    results = {}
+    for kind, work_id in [("multi_chapter", 1), ("oneshot", 4), ("empty", 10)]:
+        html = server.work_page(work_id)
+        link = f"{server.base_url}/works/{work_id}{FULL_WORK_SUFFIX}"
+        start = time.perf_counter()
+        for _ in range(repeats):
+            parse_work(html, link)
+        results[kind] = (time.perf_counter() - start) / repeats
+    return results
+
+
+def bench_crawl(name, crawl, num_pages):
+    start = time.perf_counter()
+    work_details = crawl()
+    elapsed = time.perf_counter() - start
+    result = {
+        "seconds": elapsed,
+        "pages_per_sec": num_pages / elapsed,
+        "works": len(work_details),
+        "works_per_sec": len(work_details) / elapsed,
+    }
+    print(
+        f"{name}: {result['pages_per_sec']:.2f} pages/s, "
+        f"{result['works_per_sec']:.1f} works/s ({result['works']} works)"
+    )
+    return result, work_details
+
+
+def run(num_pages=10, works_per_page=20, num_proxies=4, error_every=25):
+    server = start_server(
+        num_pages=num_pages, works_per_page=works_per_page, error_every=error_every
+    )
+    base_query = server.search_query()
+    report = {
+        "num_pages": num_pages,
+        "works_per_page": works_per_page,
+        "num_proxies": num_proxies,
+        "error_every": error_every,
+    }
+
+    report["parse_seconds_per_work"] = bench_parse(server)
+    for kind, seconds in report["parse_seconds_per_work"].items():
+        print(f"parse_work ({kind}): {seconds * 1000:.2f} ms")
+
+    fetcher = HttpFetcher(None, None)
+    report["scrape_page"], _ = bench_crawl(
+        "scrape_page",
+        lambda: scrape_page(fetcher, base_query + "&page=1")[0],
+        1,
+    )
+    fetcher.close()
+
+    pool = unthrottled_pool(1)
+    report["scrape_all_pages"], _ = bench_crawl(
+        "scrape_all_pages",
+        lambda: scrape_all_pages(1, num_pages, base_query, pool),
+        num_pages,
+    )
+    pool.close()
+
+    pool = unthrottled_pool(num_proxies)
+    report["scrape_all_pages_concurrent"], work_details = bench_crawl(
+        f"scrape_all_pages_concurrent ({num_proxies} workers)",
+        lambda: scrape_all_pages_concurrent(1, num_pages, base_query, pool),
+        num_pages,
+    )
+    pool.close()
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        start = time.perf_counter()
+        make_csv(work_details, os.path.join(output_dir, "bench"))
+        elapsed = time.perf_counter() - start
+    report["make_csv"] = {
+        "seconds": elapsed,
+        "works_per_sec": len(work_details) / elapsed,
+    }
+    print(f"make_csv: {report['make_csv']['works_per_sec']:.1f} works/s")
+
+    report["peak_rss_mb"] = peak_rss_mb()
+    print(f"Peak RSS: {report['peak_rss_mb']:.1f} MB")
+
+    server.shutdown()
+    return report
+
+
+if __name__ == "__main__":
+    # Usage: python bench/bench_scrape.py [num_pages] [report.json]
+    num_pages = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    report = run(num_pages=num_pages)
+
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], "w") as file:
+            json.dump(report, file, indent=2)
+        print(f"Report saved to {sys.argv[2]}")
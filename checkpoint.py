@@ -0,0 +1,107 @@
+import glob
+import gzip
+import hashlib
+import json
+import os
+import threading
+
+
+def iter_shard_records(directory):
+    """Yield every work record stored in the shards under `directory`."""
+    for path in sorted(glob.glob(os.path.join(directory, "works-*.jsonl.gz"))):
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue
+        except (EOFError, gzip.BadGzipFile):
+            # A member truncated by a crash ends the readable part of the shard
+            continue
+
+
+class Checkpoint:
+    """Append-only page shards and a manifest of finished pages for one query.
+
+    Every process appends the works of each page to its own gzip shard as
+    soon as the page is scraped, then records the page number in its own
+    manifest. A restarted run with the same query skips every page listed
+    in any manifest. Pages written but never recorded (a crash in between)
+    are scraped again, and `works` keeps one copy of each work.
+
+    `query` should pin down the results, so relative date windows are
+    resolved first (see scrape.resolve_query).
+    """
+
+    def __init__(self, root, query):
+        key = hashlib.sha1(query.encode("utf-8")).hexdigest()[:16]
+        self.directory = os.path.join(root, key)
+        os.makedirs(self.directory, exist_ok=True)
+
+        with open(os.path.join(self.directory, "query.txt"), "w") as file:
+            file.write(query)
+
+        pid = os.getpid()
+        self.shard_path = os.path.join(self.directory, f"works-{pid}.jsonl.gz")
+        self.manifest_path = os.path.join(self.directory, f"manifest-{pid}.txt")
+        self.lock = threading.Lock()
+
+    def done_pages(self):
+        pages = set()
+        for path in glob.glob(os.path.join(self.directory, "manifest-*.txt")):
+            with open(path, "r") as file:
+                for line in file:
+                    # Skip a line cut short by a crash
+                    if line.strip().isdigit():
+                        pages.add(int(line))
+        return pages
+
+    def write_page(self, page, page_works, complete=True):
+        """Append a page's works to the shard and, if complete, mark it done."""
+        with self.lock:
+            # Each write is its own gzip member, so a crash only loses this page
+            with gzip.open(self.shard_path, "at", encoding="utf-8") as file:
+                for work_info in page_works:
+                    file.write(json.dumps({"page": page, **work_info}) + "\n")
+                file.flush()
+                os.fsync(file.fileno())
+
+            if complete:
+                with open(self.manifest_path, "a") as file:
+                    file.write(f"{page}\n")
+                    file.flush()
+                    os.fsync(file.fileno())
+
+    def works(self, start_page=None, end_page=None):
+        """The stored works, one per URL, streamed from the shards on each pass.
+
+        `start_page` and `end_page` limit them to one slice of pages.
+        """
+        return StoredWorks(self.directory, start_page, end_page)
+
+
+class StoredWorks:
+    """Works in a checkpoint's shards, read afresh each time it is iterated.
+
+    Works come in shard order, the first copy of each URL only, so nothing
+    but the URLs seen is held in memory.
+    """
+
+    def __init__(self, directory, start_page=None, end_page=None):
+        self.directory = directory
+        self.start_page = start_page
+        self.end_page = end_page
+
+    def __iter__(self):
+        seen = set()
+        for record in iter_shard_records(self.directory):
+            page = record.pop("page")
+            if self.start_page is not None and page < self.start_page:
+                continue
+            if self.end_page is not None and page > self.end_page:
+                continue
+            if record["url"] in seen:
+                continue
+            seen.add(record["url"])
+            yield record
@@ -0,0 +1,139 @@
+import json
+import math
+import re
+import sys
+
+from bs4 import BeautifulSoup
+
+from scrape import (
+    BASE_QUERY_TEMPLATE,
+    FETCH_BACKEND,
+    PROXIES,
+    ProxyPool,
+    get_date_range_from_string,
+    parse_num_pages,
+)
+
+WORKS_PER_PAGE = 20
+
+# AO3 stops paginating search results past this page
+PAGE_LIMIT = 5000
+
+# Tries per result count; one failed probe would otherwise abort the plan
+PROBE_ATTEMPTS = 5
+
+
+def parse_result_count(html):
+    """Number of works a search found, from its "N Found" heading."""
+    soup = BeautifulSoup(html, "html.parser")
+    for heading in soup.select("h3.heading"):
+        match = re.search(r"([\d,]+)\s+Found", heading.get_text())
+        if match:
+            return int(match.group(1).replace(",", ""))
+
+    # No heading: fall back to an upper bound from the pagination widget
+    if soup.select_one(".work.index.group li.work") is None:
+        return 0
+    return parse_num_pages(html) * WORKS_PER_PAGE
+
+
+def count_results(proxy_pool, template, start_month, end_month):
+    mos = f"{start_month}-{end_month}+months"
+    html = proxy_pool.get(template.format(mos=mos), attempts=PROBE_ATTEMPTS)
+    count = parse_result_count(html)
+    print(f"{get_date_range_from_string(mos)}: {count} works")
+    return count
+
+
+def plan_windows(proxy_pool, template, start_month, end_month, page_limit=PAGE_LIMIT):
+    """Split a span of months into revised_at windows under `page_limit` pages.
+
+    Windows that are still too big are halved until they fit or are a single
+    month wide. Returns (start_month, end_month, count) for every window with
+    results, newest first. AO3 month ranges include both ends, so a window
+    is split into [start, middle] and [middle + 1, end]: the windows cover
+    the span without gaps, and no month (nor its works) is in two of them.
+    """
+    windows = []
+    pending = [(start_month, end_month)]
+    while pending:
+        start, end = pending.pop()
+        count = count_results(proxy_pool, template, start, end)
+        if count == 0:
+            continue
+
+        if math.ceil(count / WORKS_PER_PAGE) <= page_limit or start == end:
+            if math.ceil(count / WORKS_PER_PAGE) > page_limit:
+                print(
+                    f"{start}-{end} months still has {count} works; "
+                    f"pages past {page_limit} are lost"
+                )
+            windows.append((start, end, count))
+            continue
+
+        middle = (start + end) // 2
+        # Pushed in reverse so windows come off the stack newest first
+        pending.append((middle + 1, end))
+        pending.append((start, middle))
+
+    return windows
+
+
+def plan_tasks(windows, num_workers, pages_per_task=50, page_limit=PAGE_LIMIT):
+    """Cut windows into page slices and deal them out to balance page counts.
+
+    Slices are assigned largest first to whichever worker has the fewest
+    pages so far.
+    """
+    tasks = []
+    for start, end, count in windows:
+        num_pages = min(math.ceil(count / WORKS_PER_PAGE), page_limit)
+        for start_page in range(1, num_pages + 1, pages_per_task):
+            end_page = min(start_page + pages_per_task - 1, num_pages)
+            tasks.append(
+                {
+                    "mos": f"{start}-{end}+months",
+                    "start_page": start_page,
+                    "end_page": end_page,
+                    "pages": end_page - start_page + 1,
+                }
+            )
+
+    workers = [{"pages": 0, "tasks": []} for _ in range(num_workers)]
+    for task in sorted(tasks, key=lambda task: task["pages"], reverse=True):
+        worker = min(workers, key=lambda worker: worker["pages"])
+        worker["tasks"].append(task)
+        worker["pages"] += task["pages"]
+
+    return workers
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 5:
+        print(
+            "Usage: python planner.py [start_month] [end_month] [num_workers] [plan.json]"
+        )
+        sys.exit(-1)
+
+    start_month = int(sys.argv[1])
+    end_month = int(sys.argv[2])
+    num_workers = int(sys.argv[3])
+    plan_path = sys.argv[4]
+
+    proxy_pool = ProxyPool(PROXIES, backend=FETCH_BACKEND)
+    windows = plan_windows(proxy_pool, BASE_QUERY_TEMPLATE, start_month, end_month)
+    proxy_pool.close()
+
+    plan = {
+        "windows": [
+            {"mos": f"{start}-{end}+months", "works": count}
+            for start, end, count in windows
+        ],
+        "workers": plan_tasks(windows, num_workers),
+    }
+    with open(plan_path, "w") as file:
+        json.dump(plan, file, indent=2)
+
+    for i, worker in enumerate(plan["workers"]):
+        print(f"Worker {i}: {worker['pages']} pages in {len(worker['tasks'])} tasks")
+    print(f"Plan saved to {plan_path}. Run: python scrape.py {plan_path} [worker]")
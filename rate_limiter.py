@@ -0,0 +1,116 @@
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+
+class Throttled(Exception):
+    """The site asked us to slow down (429/503 or its "Retry later" page)."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header, either delta-seconds or a date."""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class RateLimiter:
+    """Token bucket for one proxy that adapts to how the site responds.
+
+    `wait` blocks until a request may be sent. After each response, `record`
+    adjusts the rate: throttling halves it and pauses the bucket for the
+    Retry-After time, or an exponential backoff when there is none. Slow
+    responses ease the rate down, and every `ramp_after` fast successes in a
+    row raise it by `increase` requests per second, up to `max_rate`.
+    """
+
+    def __init__(
+        self,
+        rate=1.0,
+        min_rate=0.05,
+        max_rate=10.0,
+        burst=2,
+        increase=0.25,
+        ramp_after=10,
+        target_latency=3.0,
+        base_backoff=5.0,
+        max_backoff=600.0,
+    ):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.ramp_after = ramp_after
+        self.target_latency = target_latency
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.throttles = 0
+        self.successes = 0
+        self.lock = threading.Lock()
+
+    def scale(self, factor):
+        """Run at `factor` times the rate, e.g. one of several processes' share."""
+        with self.lock:
+            self.rate *= factor
+            self.min_rate *= factor
+            self.max_rate *= factor
+            self.increase *= factor
+        return self
+
+    def wait(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(delay)
+
+    def record(self, latency, throttled=False, retry_after=None):
+        with self.lock:
+            if throttled:
+                self.throttles += 1
+                self.successes = 0
+                self.rate = max(self.min_rate, self.rate / 2)
+
+                if retry_after is None:
+                    retry_after = min(
+                        self.base_backoff * 2 ** (self.throttles - 1), self.max_backoff
+                    )
+                self.blocked_until = time.monotonic() + retry_after
+                self.tokens = 0
+                return
+
+            self.throttles = 0
+            if latency is not None and latency > self.target_latency:
+                # The site is straining; ease off before it starts refusing
+                self.successes = 0
+                self.rate = max(self.min_rate, self.rate * 0.9)
+                return
+
+            self.successes += 1
+            if self.successes >= self.ramp_after:
+                self.successes = 0
+                self.rate = min(self.max_rate, self.rate + self.increase)
@@ -0,0 +1,106 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+
+def normalize_url(url):
+    """Canonical form of a URL so equivalent links share one cache entry."""
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+
+    # Drop default ports, fragments and the order of query parameters
+    if parts.port and not (
+        (scheme == "http" and parts.port == 80)
+        or (scheme == "https" and parts.port == 443)
+    ):
+        host = f"{host}:{parts.port}"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+
+    return urlunsplit((scheme, host, parts.path or "/", query, ""))
+
+
+class ResponseCache:
+    """Raw page HTML on disk, gzip-compressed and keyed by normalized URL.
+
+    Each entry is `<sha256>.html.gz` with a `<sha256>.json` sidecar holding the
+    URL, fetch time and TTL. Entries older than their TTL count as misses;
+    a TTL of None never expires. In offline mode entries never expire and a
+    miss raises instead of going to the network.
+    """
+
+    def __init__(self, root, ttl=None, offline=False):
+        self.root = root
+        self.ttl = ttl
+        self.offline = offline
+        self.hits = 0
+        self.misses = 0
+
+    def path_for(self, url):
+        key = hashlib.sha256(normalize_url(url).encode("utf-8")).hexdigest()
+        # Fan out into subdirectories so no single directory grows huge
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, url):
+        """Return the cached HTML for `url`, or None if missing or expired."""
+        path = self.path_for(url)
+        try:
+            with open(path + ".json", "r", encoding="utf-8") as file:
+                meta = json.load(file)
+            if (
+                not self.offline
+                and meta["ttl"] is not None
+                and time.time() > meta["fetched_at"] + meta["ttl"]
+            ):
+                return None
+            with gzip.open(path + ".html.gz", "rt", encoding="utf-8") as file:
+                return file.read()
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def put(self, url, html):
+        path = self.path_for(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to temporary files first so readers never see half an entry;
+        # their names are unique to this thread so writers never share one
+        tmp = f".{os.getpid()}-{threading.get_ident()}.tmp"
+        with gzip.open(path + ".html.gz" + tmp, "wt", encoding="utf-8") as file:
+            file.write(html)
+        with open(path + ".json" + tmp, "w", encoding="utf-8") as file:
+            json.dump({"url": url, "fetched_at": time.time(), "ttl": self.ttl}, file)
+        os.replace(path + ".html.gz" + tmp, path + ".html.gz")
+        os.replace(path + ".json" + tmp, path + ".json")
+
+    def delete(self, url):
+        path = self.path_for(url)
+        for suffix in (".json", ".html.gz"):
+            try:
+                os.remove(path + suffix)
+            except FileNotFoundError:
+                pass
+
+    def fetch(self, url, fetcher, refresh=False):
+        """Return cached HTML for `url`, fetching and storing it on a miss.
+
+        With `refresh`, the page is fetched again and the entry replaced
+        unless the cache is offline. Only 200 responses are stored, so an
+        error page is never served back later.
+        """
+        html = None if refresh and not self.offline else self.get(url)
+        if html is not None:
+            self.hits += 1
+            return html
+
+        self.misses += 1
+        if self.offline or fetcher is None:
+            raise KeyError(f"{url} is not cached")
+
+        status, html = fetcher.fetch(url)
+        if status == 200:
+            self.put(url, html)
+        return html
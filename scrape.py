@@ -1,15 +1,30 @@
+import json
+import queue
+import random
 import re
+import sys
+import threading
 import time
 from datetime import datetime, timedelta
+from urllib.parse import urljoin
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import requests
 from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 from selenium import webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.firefox.options import Options
 from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait
 
+from checkpoint import Checkpoint
+from rate_limiter import RateLimiter, Throttled, parse_retry_after
+from response_cache import ResponseCache
+from work_index import WorkIndex
+
 
 def get_date_range_from_string(mos):
     # Extract start and end values using regex
@@ -31,40 +46,287 @@ def get_date_range_from_string(mos):
     return f"{end_date.strftime('%Y-%m-%d')} to {start_date.strftime('%Y-%m-%d')}"
 
 
-class ProxyRotator:
-    def __init__(self, proxies):
-        self.proxies = proxies
-        self.current_proxy_index = 0
-
-    def get_driver(self):
-        """Create a WebDriver instance with the current proxy and rotate to the next one."""
-        # Get the current proxy
-        host = self.proxies[self.current_proxy_index][0]
-        port = self.proxies[self.current_proxy_index][1]
-
-        # Update the index to the next proxy
-        self.current_proxy_index = (self.current_proxy_index + 1) % len(self.proxies)
-
-        options = Options()
-        options.set_preference("network.proxy.type", 1)
-        options.set_preference("network.proxy.http", host)
-        options.set_preference("network.proxy.http_port", port)
-        options.set_preference("network.proxy.ssl", host)
-        options.set_preference("network.proxy.ssl_port", port)
-        options.set_preference("network.proxy.no_proxies_on", "")
-
-        options.add_argument("-headless")
-
-        # Create and return a new WebDriver instance
-        driver = webdriver.Firefox(
-            options=options,
-        )
+def resolve_query(base_query):
+    """`base_query` with its relative revised_at window as today's dates.
+
+    Checkpoints are keyed on this, so the same relative window run on a
+    later day starts afresh instead of reusing pages of the old dates.
+    """
+    return re.sub(
+        r"\d+-\d+\+months",
+        lambda match: get_date_range_from_string(match.group(0)),
+        base_query,
+    )
+
+
+FULL_WORK_SUFFIX = "?view_full_work=true&view_adult=true"
+
+USER_AGENT = (
+    "Mozilla/5.0 (X11; Linux x86_64; rv:131.0) Gecko/20100101 Firefox/131.0"
+)
+
+
+def is_retry_later(html):
+    # AO3 answers overload with a tiny "Retry later" page, sometimes with a 200
+    return len(html) < 5000 and "Retry later" in html
 
-        return driver
 
+def firefox_options(host, port):
+    options = Options()
+    options.set_preference("network.proxy.type", 1)
+    options.set_preference("network.proxy.http", host)
+    options.set_preference("network.proxy.http_port", port)
+    options.set_preference("network.proxy.ssl", host)
+    options.set_preference("network.proxy.ssl_port", port)
+    options.set_preference("network.proxy.no_proxies_on", "")
+
+    options.add_argument("-headless")
+    return options
+
+
+class HttpFetcher:
+    """Fetch raw HTML over a keep-alive requests session bound to one proxy."""
+
+    def __init__(self, host, port, timeout=30, limiter=None):
+        self.timeout = timeout
+        self.limiter = limiter
+        self.num_requests = 0
+        self.session = requests.Session()
+        self.session.headers["User-Agent"] = USER_AGENT
+
+        # One small connection pool per proxy, reused across pages
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        # A host of None talks to the site directly
+        if host:
+            proxy = f"http://{host}:{port}"
+            self.session.proxies = {"http": proxy, "https": proxy}
+
+    def get(self, url):
+        return self.fetch(url)[1]
+
+    def fetch(self, url):
+        """(status code, HTML) of `url`."""
+        if self.limiter is not None:
+            self.limiter.wait()
+        self.num_requests += 1
+        start = time.monotonic()
+        response = self.session.get(url, timeout=self.timeout)
+        latency = time.monotonic() - start
+
+        if response.status_code in (429, 503) or is_retry_later(response.text):
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            if self.limiter is not None:
+                self.limiter.record(latency, throttled=True, retry_after=retry_after)
+            raise Throttled(f"Throttled ({response.status_code}) at {url}", retry_after)
+
+        if self.limiter is not None:
+            self.limiter.record(latency)
+        # Like a browser, 404s of deleted works still yield a page; only
+        # server errors are worth a retry
+        if response.status_code >= 500:
+            response.raise_for_status()
+        return response.status_code, response.text
+
+    def close(self):
+        self.session.close()
+
+
+class SeleniumFetcher:
+    """Fetch rendered HTML through a headless Firefox. Slow; kept as a fallback."""
+
+    def __init__(self, host, port, limiter=None):
+        self.limiter = limiter
+        self.num_requests = 0
+        self.driver = webdriver.Firefox(options=firefox_options(host, port))
+
+    def get(self, url):
+        return self.fetch(url)[1]
+
+    def fetch(self, url):
+        """(status code, HTML) of `url`; a browser doesn't tell the status."""
+        if self.limiter is not None:
+            self.limiter.wait()
+        self.num_requests += 1
+        start = time.monotonic()
+        self.driver.get(url)
+        html = self.driver.page_source
+        latency = time.monotonic() - start
+
+        throttled = is_retry_later(html)
+        if self.limiter is not None:
+            self.limiter.record(latency, throttled=throttled)
+        if throttled:
+            raise Throttled(f"Throttled at {url}")
+        return None, html
+
+    def close(self):
+        self.driver.quit()
+
+
+class ProxyPool:
+    """Long-lived fetchers for each proxy, handed out healthiest first.
+
+    Every proxy keeps one warm fetcher that is reused across pages, along with
+    its success and failure counts and a moving average of request latency.
+    A proxy that fails `max_failures` times in a row is quarantined for
+    `cooldown` seconds before it gets work again. Each proxy also has its own
+    adaptive `RateLimiter` that paces every request its fetcher sends; when
+    other processes crawl through the same proxies, `rate_share` is the
+    fraction of each proxy's rate this pool may use.
+    """
+
+    def __init__(
+        self, proxies, backend="http", max_failures=3, cooldown=300, rate_share=1.0
+    ):
+        if backend not in ("http", "selenium"):
+            raise ValueError(f"Unknown fetch backend: {backend}")
+
+        self.proxies = proxies
+        self.backend = backend
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+
+        self.stats = [
+            {
+                "successes": 0,
+                "failures": 0,
+                "consecutive_failures": 0,
+                "latency": None,
+                "quarantined_until": 0.0,
+            }
+            for _ in proxies
+        ]
+        self.limiters = [RateLimiter().scale(rate_share) for _ in proxies]
+        self.fetchers = {}
+        # Proxies whose fetcher is checked out, and the lease of each fetcher
+        self.busy = set()
+        self.leases = {}
+        self.condition = threading.Condition()
+
+    def score(self, index):
+        """Smoothed success rate per second of latency; higher is healthier."""
+        stats = self.stats[index]
+        success_rate = (stats["successes"] + 1) / (
+            stats["successes"] + stats["failures"] + 2
+        )
+        latency = stats["latency"] if stats["latency"] is not None else 1.0
+        return success_rate / max(latency, 0.05)
+
+    def acquire(self):
+        """Check out the fetcher of the healthiest idle, non-quarantined proxy.
+
+        Blocks while every proxy is busy or quarantined.
+        """
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                idle = [i for i in range(len(self.proxies)) if i not in self.busy]
+                candidates = [
+                    i for i in idle if self.stats[i]["quarantined_until"] <= now
+                ]
+                if candidates:
+                    # Shuffle first so untried proxies with equal scores share the load
+                    random.shuffle(candidates)
+                    index = max(candidates, key=self.score)
+                    self.busy.add(index)
+                    break
+
+                # Wake up when a fetcher is returned or the next cooldown ends
+                cooldowns = [self.stats[i]["quarantined_until"] - now for i in idle]
+                self.condition.wait(min(cooldowns) if cooldowns else None)
+
+        # Start the fetcher outside the lock; a browser takes seconds
+        try:
+            fetcher = self.fetchers.get(index)
+            if fetcher is None:
+                host, port = self.proxies[index]
+                limiter = self.limiters[index]
+                if self.backend == "selenium":
+                    fetcher = SeleniumFetcher(host, port, limiter=limiter)
+                else:
+                    fetcher = HttpFetcher(host, port, limiter=limiter)
+                self.fetchers[index] = fetcher
+        except Exception:
+            with self.condition:
+                self.busy.discard(index)
+                self.record(index, False, None)
+                self.condition.notify_all()
+            raise
+
+        with self.condition:
+            self.leases[id(fetcher)] = (index, fetcher.num_requests, time.monotonic())
+        return fetcher
+
+    def release(self, fetcher, ok=True):
+        """Return a fetcher and record whether the work done with it succeeded."""
+        with self.condition:
+            index, num_requests, start = self.leases.pop(id(fetcher))
+            requests_made = max(fetcher.num_requests - num_requests, 1)
+            self.record(index, ok, (time.monotonic() - start) / requests_made)
+
+            # A browser that errored may be wedged; start a fresh one next time
+            if not ok and self.backend == "selenium":
+                del self.fetchers[index]
+                fetcher.close()
+
+            self.busy.discard(index)
+            self.condition.notify_all()
+
+    def get(self, url, attempts=1):
+        """Fetch one URL on whichever proxy is healthiest right now."""
+        return self.fetch(url, attempts)[1]
+
+    def fetch(self, url, attempts=1):
+        """(status code, HTML) of `url`, tried up to `attempts` times.
+
+        A failed attempt (throttling included) counts against its proxy, so
+        the next one goes to whichever proxy is healthiest then.
+        """
+        for attempt in range(attempts):
+            fetcher = self.acquire()
+            try:
+                response = fetcher.fetch(url)
+            except Exception as e:
+                self.release(fetcher, ok=False)
+                if attempt + 1 == attempts:
+                    raise
+                print(f"Attempt {attempt}: An error occurred:", e)
+                continue
+            self.release(fetcher)
+            return response
+
+    def record(self, index, ok, latency):
+        stats = self.stats[index]
+        if ok:
+            stats["successes"] += 1
+            stats["consecutive_failures"] = 0
+            if stats["latency"] is None:
+                stats["latency"] = latency
+            else:
+                stats["latency"] = 0.8 * stats["latency"] + 0.2 * latency
+        else:
+            stats["failures"] += 1
+            stats["consecutive_failures"] += 1
+            if stats["consecutive_failures"] >= self.max_failures:
+                stats["quarantined_until"] = time.monotonic() + self.cooldown
+                stats["consecutive_failures"] = 0
+                print(f"Quarantining {self.proxies[index]} for {self.cooldown}s")
+
+    def report(self):
+        for proxy, stats, limiter in zip(self.proxies, self.stats, self.limiters):
+            latency = stats["latency"] or 0.0
+            print(
+                f"{proxy}: {stats['successes']} ok, {stats['failures']} failed, "
+                f"{latency:.2f}s per request, {limiter.rate:.2f} requests/s"
+            )
 
-def custom_sleep(amount=0.1):
-    time.sleep(amount)
+    def close(self):
+        for fetcher in self.fetchers.values():
+            fetcher.close()
+        self.fetchers = {}
 
 
 def clear_tos(driver):
@@ -84,204 +346,566 @@ def clear_tos(driver):
     accept_button.click()
 
 
-# Function to scrape a single page
-def scrape_page(driver, page_link):
-    work_details = []
-    num_empty_works = 0
-    driver.get(page_link)
-    custom_sleep()
+def element_text(element):
+    """Text of a metadata element, with tag lists joined by commas."""
+    items = element.find_all("li")
+    if items:
+        return ", ".join(item.get_text(" ", strip=True) for item in items)
+    return " ".join(element.get_text(" ", strip=True).split())
 
-    works_list = WebDriverWait(driver, 10).until(
-        EC.presence_of_element_located((By.CLASS_NAME, "work.index.group"))
-    )
 
-    # Find all the work items
-    work_items = works_list.find_elements(By.CSS_SELECTOR, "li.work")
+def parse_num_pages(html):
+    soup = BeautifulSoup(html, "html.parser")
 
-    # Initialize a list to store the links
-    work_links = []
+    # Find the pagination section
+    pagination = soup.find("ol", class_="pagination actions")
 
-    # Iterate over each work item to extract the link
-    for work in work_items:
-        try:
-            link_element = work.find_element(
-                By.CSS_SELECTOR, "div.header.module h4.heading a"
-            )
-            work_link = (
-                link_element.get_attribute("href")
-                + "?view_full_work=true&view_adult=true"
-            )
-            work_links.append(work_link)
-        except Exception as e:
-            print(e)
-            continue
+    # A single page of results has no pagination widget
+    if pagination is None:
+        return 1
 
-    for work in work_links:
-        driver.get(work)
+    # Get the last page number
+    pages = pagination.find_all("li")
+    return int(pages[-2].text.strip())
 
-        work_info = {"url": work.replace("?view_full_work=true&view_adult=true", "")}
-        # work_info = {"url": work}
 
-        # Wait for the work page to load
-        custom_sleep()
+def parse_revised_date(text):
+    """Turn a listing date like '08 Jan 2023' into '2023-01-08'."""
+    try:
+        return datetime.strptime(text.strip(), "%d %b %Y").strftime("%Y-%m-%d")
+    except ValueError:
+        return None
 
-        # Get the metadata
-        try:
-            meta_dl = driver.find_element(By.CSS_SELECTOR, "dl.work.meta.group")
-            dt_elements = meta_dl.find_elements(By.TAG_NAME, "dt")
-            dd_elements = meta_dl.find_elements(By.TAG_NAME, "dd")
-            metadata = {
-                dt.text[:-1]: dd.text for dt, dd in zip(dt_elements, dd_elements)
+
+def parse_listing(html, page_link):
+    """Link, last revised date, chapters and word count of each listed work."""
+    soup = BeautifulSoup(html, "html.parser")
+
+    works_list = soup.select_one(".work.index.group")
+    if works_list is None:
+        raise ValueError(f"No work listing found on {page_link}")
+
+    # Iterate over each work item to extract the link and blurb stats
+    entries = []
+    for work in works_list.select("li.work"):
+        link_element = work.select_one("div.header.module h4.heading a")
+        if link_element is None or not link_element.get("href"):
+            print(f"No link found for {work.get('id')}")
+            continue
+
+        date_element = work.select_one("p.datetime")
+        chapters_element = work.select_one("dd.chapters")
+        words_element = work.select_one("dd.words")
+        entries.append(
+            {
+                "link": urljoin(page_link, link_element["href"]) + FULL_WORK_SUFFIX,
+                "revised": date_element and parse_revised_date(date_element.text),
+                "chapters": chapters_element
+                and "".join(chapters_element.get_text().split()),
+                "words": words_element and words_element.get_text(strip=True),
             }
-            work_info["metadata"] = metadata
-        except:
-            work_info["metadata"] = None
+        )
 
-        try:
-            chapter_texts = driver.find_elements(By.CSS_SELECTOR, "div.userstuff")
-            full_text = ""
-            for chapter in chapter_texts:
-                soup = BeautifulSoup(chapter.get_attribute("outerHTML"), "html.parser")
-                chapter_text = soup.get_text()
-                full_text += chapter_text + "\n\n"
-            if not bool(full_text.strip()):
-                print(work)
-                num_empty_works += 1
-            # full_text = get_all_chapter_text(driver)
-            work_info["text"] = full_text
-        except:
-            work_info["text"] = None
+    return entries
+
+
+def parse_work_links(html, page_link):
+    return [entry["link"] for entry in parse_listing(html, page_link)]
+
+
+def parse_work(html, work_link, revised=None):
+    soup = BeautifulSoup(html, "html.parser")
+    work_info = {"url": work_link.replace(FULL_WORK_SUFFIX, "")}
+
+    # Get the metadata; the nested stats list contributes its own dt/dd pairs
+    meta_dl = soup.select_one("dl.work.meta.group")
+    if meta_dl is not None:
+        dt_elements = meta_dl.find_all("dt")
+        dd_elements = meta_dl.find_all("dd")
+        work_info["metadata"] = {
+            element_text(dt)[:-1]: element_text(dd)
+            for dt, dd in zip(dt_elements, dd_elements)
+        }
+        # Keep the listing's revision date so later runs can tell if it changed
+        if revised:
+            work_info["metadata"]["Revised"] = revised
+    else:
+        work_info["metadata"] = None
+
+    full_text = ""
+    for chapter in soup.select("div.userstuff"):
+        full_text += chapter.get_text() + "\n\n"
+    work_info["text"] = full_text
+
+    return work_info
+
+
+def fetch_html(fetcher, url, cache=None, refresh=False):
+    """Fetch a page through the response cache when one is configured.
+
+    With `refresh`, the page is fetched even if cached (and the cache entry
+    replaced), unless the cache is offline.
+    """
+    if cache is None:
+        return fetcher.get(url)
+    return cache.fetch(url, fetcher, refresh=refresh)
+
+
+def fetch_listing(fetcher, page_link, cache=None):
+    # Listings change as works are posted and revised, so they are always
+    # fetched afresh; the cache keeps them for offline re-parsing only
+    try:
+        html = fetch_html(fetcher, page_link, cache, refresh=True)
+        return parse_listing(html, page_link)
+    except ValueError:
+        # Don't keep serving an error page from the cache
+        if cache is not None:
+            cache.delete(page_link)
+        raise
+
+
+def fetch_work(fetcher, entry, cache=None, index=None):
+    """Fetch and parse the work of a listing entry.
+
+    A work the `index` holds an older version of was changed since, and a
+    cached copy may be that older version too, so it is fetched afresh.
+    """
+    url = entry["link"]
+    refresh = index is not None and index.is_known(entry)
+    html = fetch_html(fetcher, url, cache, refresh=refresh)
+    return parse_work(html, url, entry["revised"])
+
+
+# Function to scrape a single page
+def scrape_page(fetcher, page_link, cache=None, index=None):
+    """Scrape every work listed on a search page.
+
+    With a work `index`, works it already holds unchanged are not fetched.
+    """
+    work_details = []
+    num_empty_works = 0
+
+    entries = fetch_listing(fetcher, page_link, cache)
+    if index is not None:
+        entries = index.changed(entries)
+
+    for entry in entries:
+        work = entry["link"]
+        work_info = fetch_work(fetcher, entry, cache, index)
+
+        if not work_info["text"].strip():
+            print(work)
             num_empty_works += 1
+        elif index is not None:
+            index.add_work(work_info)
 
         work_details.append(work_info)
 
     return work_details, num_empty_works
 
 
-def make_csv(work_details, name):
+# Metadata keys that AO3 names in the singular or plural depending on count
+COMBINE_COLUMNS = {
+    "Relationships": ["Relationship", "Relationships"],
+    "Characters": ["Character", "Characters"],
+    "Categories": ["Category", "Categories"],
+    "Fandom": ["Fandom", "Fandoms"],
+    "Archive Warnings": ["Archive Warning", "Archive Warnings"],
+}
+
+ALWAYS_COLUMNS = [
+    "Bookmarks",
+    "Published",
+    "Updated",
+    "Hits",
+    "Words",
+    "Chapters",
+    "Comments",
+    "Kudos",
+]
+
+# Counts are scraped with thousands separators, dates as YYYY-MM-DD
+NUMERIC_COLUMNS = ["Bookmarks", "Comments", "Hits", "Kudos", "Words"]
+DATE_COLUMNS = ["Completed", "Published", "Revised", "Updated"]
 
-    if not work_details:
-        print("No data")
-        return
 
-    # Convert the list of work details to a DataFrame
-    df = pd.DataFrame(work_details)
-
-    # Define the combinations of columns
-    combine_columns = {
-        "Relationships": ["Relationship", "Relationships"],
-        "Characters": ["Character", "Characters"],
-        "Categories": ["Category", "Categories"],
-        "Fandom": ["Fandom", "Fandoms"],
-        "Archive Warnings": ["Archive Warning", "Archive Warnings"],
-    }
-
-    # Extract all unique keys from the dictionary column
-    all_keys = set()
-    for d in df["metadata"]:
-        if d:
-            all_keys.update(d.keys())
-
-    # Create new columns for each unique key
-    for key, aliases in combine_columns.items():
-        df[key] = df["metadata"].apply(
-            lambda x: next((x[k] for k in aliases if x and k in x), None)
-        )
+# Works normalized and written at a time by `make_csv`
+WRITE_BATCH = 500
+
+# Rank each alias so the first one listed wins when a work has both
+ALIAS_OF = {
+    alias: (key, rank)
+    for key, aliases in COMBINE_COLUMNS.items()
+    for rank, alias in enumerate(aliases)
+}
+
+
+def flatten_work(work):
+    """One output row of a work: its URL, text and metadata."""
+    row = {"url": work.get("url"), "text": work.get("text")}
+    ranks = {}
+    for key, value in (work.get("metadata") or {}).items():
+        if key == "Stats":
+            continue
+        if key in ALIAS_OF:
+            key, rank = ALIAS_OF[key]
+            if ranks.get(key, len(COMBINE_COLUMNS[key])) < rank:
+                continue
+            ranks[key] = rank
+        row[key] = value
+    return row
 
-        # Drop the column if it is entirely blank (i.e., all values are None)
-        if df[key].isnull().all():
-            df.drop(columns=[key], inplace=True)
-
-    always_cols = [
-        "Bookmarks",
-        "Published",
-        "Updated",
-        "Hits",
-        "Words",
-        "Chapters",
-        "Comments",
-        "Kudos",
-    ]
-    for col in always_cols:
-        if col not in df.columns:
-            df[col] = None
-
-    # Add any remaining keys that were not combined
-    for key in all_keys:
-        if key not in [col for cols in combine_columns.values() for col in cols]:
-            df[key] = df["metadata"].apply(lambda x: x.get(key, None) if x else None)
-
-    df = df.drop(columns=["metadata"])
-    if "Stats" in df.columns:
-        df = df.drop(columns=["Stats"])
 
+def work_columns(works):
+    """The output columns of `works`: url and text, then the rest sorted."""
     fixed = ["url", "text"]
-    # Extract and sort the remaining columns
-    sorted_columns = sorted([col for col in df.columns if col not in fixed])
+    columns = set(ALWAYS_COLUMNS)
+    for work in works:
+        columns.update(flatten_work(work))
+    return fixed + sorted(columns - set(fixed))
+
+
+def normalize_works(work_details, columns=None):
+    """Flatten the metadata of every work in one pass into a typed DataFrame.
+
+    `columns` fixes the output columns, so separately normalized batches of
+    works line up.
+    """
+    rows = [flatten_work(work) for work in work_details]
+    if columns is None:
+        columns = work_columns(work_details)
+    df = pd.DataFrame.from_records(rows).reindex(columns=columns)
+
+    for col in NUMERIC_COLUMNS:
+        values = df[col].astype("string").str.replace(",", "", regex=False)
+        df[col] = pd.to_numeric(values, errors="coerce").astype("Int64")
+    for col in DATE_COLUMNS:
+        if col in df.columns:
+            df[col] = pd.to_datetime(df[col], format="%Y-%m-%d", errors="coerce")
+    return df
+
+
+def parquet_schema(columns):
+    return pa.schema(
+        [
+            (
+                col,
+                pa.int64()
+                if col in NUMERIC_COLUMNS
+                else pa.timestamp("ns") if col in DATE_COLUMNS else pa.string(),
+            )
+            for col in columns
+        ]
+    )
 
-    # Concatenate the fixed columns with the sorted columns
-    new_order = fixed + sorted_columns
-    df = df[new_order]
 
-    # Save the DataFrame to a CSV file
-    df.to_csv(name + ".csv", index=False, encoding="utf-8")
-    # df.to_excel(name + ".xlsx", index=False)
+def make_csv(works, name, formats=("csv", "parquet"), batch_size=WRITE_BATCH):
+    """Write the works to `name`.csv and/or a zstd-compressed `name`.parquet.
 
+    `works` is read twice, first for the columns and then to write
+    `batch_size` works at a time, so a re-iterable that streams from disk
+    (see Checkpoint.works) is written without ever being held in memory.
 
-def scrape_all_pages(start_page, end_page, base_query):
-    work_details = []
+    Parquet keeps the column types, and readers that don't need the text can
+    load the other columns without parsing it.
+    """
+    if not works:
+        print("No data")
+        return
 
+    columns = work_columns(works)
+    schema = parquet_schema(columns)
+    csv_header = True
+    parquet_writer = None
+    written = 0
     try:
-        driver = proxy_rotator.get_driver()
-        driver.get(base_query)
-        custom_sleep(2)
-        # Get the page source
-        page_source = driver.page_source
-
-        # Parse the page source with BeautifulSoup
-        soup = BeautifulSoup(page_source, "html.parser")
+        for batch in iter_batches(works, batch_size):
+            written += len(batch)
+            df = normalize_works(batch, columns)
+            if "csv" in formats:
+                df.to_csv(
+                    name + ".csv",
+                    mode="w" if csv_header else "a",
+                    header=csv_header,
+                    index=False,
+                    encoding="utf-8",
+                )
+                csv_header = False
+            if "parquet" in formats:
+                table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+                if parquet_writer is None:
+                    # The first batch's schema carries pandas' column types
+                    parquet_writer = pq.ParquetWriter(
+                        name + ".parquet", table.schema, compression="zstd"
+                    )
+                parquet_writer.write_table(table)
+    finally:
+        if parquet_writer is not None:
+            parquet_writer.close()
+
+    if not written:
+        # A checkpoint slice with no works
+        print("No data")
 
-        # Find the pagination section
-        pagination = soup.find("ol", class_="pagination actions")
 
-        # Get the last page number
-        pages = pagination.find_all("li")
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def scrape_all_pages(
+    start_page,
+    end_page,
+    base_query,
+    proxy_pool,
+    cache=None,
+    checkpoint=None,
+    index=None,
+):
+    """Scrape search pages one at a time.
+
+    With an offline `cache`, `proxy_pool` may be None and every page is
+    re-parsed from disk. With a `checkpoint`, pages it has already finished
+    are skipped and each new page is streamed to its shard instead of being
+    kept in the returned list. With a work `index`, only new or changed works
+    are fetched.
+    """
+    work_details = []
+    done_pages = checkpoint.done_pages() if checkpoint is not None else set()
 
-        num_pages = int(pages[-2].text.strip())
+    try:
+        fetcher = proxy_pool.acquire() if proxy_pool else None
+        try:
+            # Probe the first page we need; like any listing, it is fetched
+            # afresh unless the cache is offline
+            page_link = base_query + f"&page={start_page}"
+            num_pages = parse_num_pages(
+                fetch_html(fetcher, page_link, cache, refresh=True)
+            )
+        except Exception:
+            if fetcher is not None:
+                proxy_pool.release(fetcher, ok=False)
+            raise
+        if fetcher is not None:
+            proxy_pool.release(fetcher)
         print(num_pages)
-        driver.quit()
 
     except Exception as e:
         print("Error determining number of pages", e)
         return
 
     for p in range(start_page, end_page + 1):
+        if p in done_pages:
+            continue
+
+        page_works = None
         for i in range(5):
+            fetcher = proxy_pool.acquire() if proxy_pool else None
             try:
-                driver = proxy_rotator.get_driver()
                 page_link = base_query + f"&page={p}"
-                page_works, num_empty_works = scrape_page(driver, page_link)
+                page_works, num_empty_works = scrape_page(
+                    fetcher, page_link, cache, index
+                )
+                if fetcher is not None:
+                    proxy_pool.release(fetcher)
                 break
             except Exception as e:
+                if fetcher is not None:
+                    proxy_pool.release(fetcher, ok=False)
                 print(f"Attempt {i}: An error occurred:", e)
-                print(
-                    f"Using proxy: {proxy_rotator.proxies[proxy_rotator.current_proxy_index]}"
-                )
-                custom_sleep(2)
-                driver.quit()
 
-        if not page_works:
+        if page_works is None:
             print(f"Could not scrape page {p}. Continuing.")
             continue
 
-        if (num_empty_works / len(page_works) * 100) != 0:
+        if page_works and (num_empty_works / len(page_works) * 100) != 0:
             print(f"Page {p}: {num_empty_works / len(page_works) * 100}% missing works")
-        work_details += page_works
+        if checkpoint is not None:
+            checkpoint.write_page(p, page_works)
+        else:
+            work_details += page_works
         if p % 20 == 0:
             print(f"Page {p}")
-        # if p % 100 == 0:
-        #     make_csv(work_details, f"{start_num}-{end_page}")
-        driver.quit()
+
+    return work_details
+
+
+def finish_page(p, page, checkpoint=None):
+    """Report on a page whose work tasks have all ended, and store it."""
+    page_works = [work for work in page["works"] if work is not None]
+    num_missing = page["failed"]
+    num_missing += sum(1 for work in page_works if not work["text"].strip())
+    if num_missing:
+        print(f"Page {p}: {num_missing / len(page['works']) * 100}% missing works")
+
+    if checkpoint is not None:
+        checkpoint.write_page(p, page_works, complete=page["failed"] == 0)
+        # The shard holds the works now; keep only the bookkeeping in memory
+        page["works"] = []
+
+
+def crawl_worker(
+    worker_id,
+    proxy_pool,
+    tasks,
+    pages,
+    lock,
+    max_attempts,
+    retry_budget,
+    cache=None,
+    checkpoint=None,
+    index=None,
+):
+    """Pull page and work tasks off the shared queue until it drains.
+
+    A task is (kind, page, slot, target, attempt), where the target is the page
+    URL or the work's listing entry. Page tasks queue one work task per listed
+    work that the `index` doesn't already hold unchanged; work tasks fill their
+    slot in `pages[page]["works"]`.
+    Failed tasks go back on the queue until `max_attempts`, and the worker
+    stops after `retry_budget` failures of its own in a row; any success
+    resets the count, so occasional throttling over a long crawl doesn't
+    wear the workers down. Each task runs on the healthiest proxy the pool
+    has free.
+    """
+    failures = 0
+    while True:
+        try:
+            task = tasks.get(timeout=1)
+        except queue.Empty:
+            # Work tasks are queued by page tasks, so wait while any are in flight
+            if tasks.unfinished_tasks == 0:
+                return
+            continue
+
+        kind, p, slot, target, attempt = task
+        finished = False
+        try:
+            if kind == "page":
+                entries = fetch_listing(proxy_pool, target, cache)
+                if index is not None:
+                    entries = index.changed(entries)
+                with lock:
+                    pages[p] = {
+                        "works": [None] * len(entries),
+                        "remaining": len(entries),
+                        "failed": 0,
+                    }
+                    finished = not entries
+                for work_slot, entry in enumerate(entries):
+                    tasks.put(("work", p, work_slot, entry, 0))
+            else:
+                work_info = fetch_work(proxy_pool, target, cache, index)
+                if index is not None and work_info["text"].strip():
+                    index.add_work(work_info)
+                with lock:
+                    pages[p]["works"][slot] = work_info
+                    pages[p]["remaining"] -= 1
+                    finished = pages[p]["remaining"] == 0
+            failures = 0
+        except Exception as e:
+            failures += 1
+            print(f"Worker {worker_id}, attempt {attempt}: An error occurred:", e)
+            if attempt + 1 < max_attempts:
+                tasks.put((kind, p, slot, target, attempt + 1))
+            else:
+                print(f"Giving up on {target}")
+                if kind == "work":
+                    with lock:
+                        pages[p]["failed"] += 1
+                        pages[p]["remaining"] -= 1
+                        finished = pages[p]["remaining"] == 0
+
+        try:
+            if finished:
+                finish_page(p, pages[p], checkpoint)
+        finally:
+            tasks.task_done()
+
+        if failures >= retry_budget:
+            print(f"Worker {worker_id} failed {failures} tasks in a row. Stopping.")
+            return
+
+
+def scrape_all_pages_concurrent(
+    start_page,
+    end_page,
+    base_query,
+    proxy_pool,
+    max_attempts=5,
+    retry_budget=20,
+    cache=None,
+    checkpoint=None,
+    index=None,
+):
+    """Scrape pages with one worker thread per proxy sharing a task queue.
+
+    Returns the same list as `scrape_all_pages`, in page order. With a
+    `checkpoint`, pages it has already finished are skipped and new pages
+    go straight to its shards instead of the returned list. With a work
+    `index`, only new or changed works are fetched.
+    """
+    done_pages = checkpoint.done_pages() if checkpoint is not None else set()
+
+    tasks = queue.Queue()
+    for p in range(start_page, end_page + 1):
+        if p not in done_pages:
+            tasks.put(("page", p, None, base_query + f"&page={p}", 0))
+    print(f"{len(done_pages)} pages already done, {tasks.qsize()} to scrape")
+
+    pages = {}
+    lock = threading.Lock()
+    threads = []
+    for i in range(len(proxy_pool.proxies)):
+        thread = threading.Thread(
+            target=crawl_worker,
+            args=(
+                i,
+                proxy_pool,
+                tasks,
+                pages,
+                lock,
+                max_attempts,
+                retry_budget,
+                cache,
+                checkpoint,
+                index,
+            ),
+            daemon=True,
+        )
+        thread.start()
+        threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+
+    if tasks.unfinished_tasks:
+        print(f"All workers stopped with {tasks.unfinished_tasks} tasks left.")
+
+    # Collect results in page order
+    work_details = []
+    incomplete = []
+    for p in range(start_page, end_page + 1):
+        if p in done_pages:
+            continue
+        if p not in pages:
+            print(f"Could not scrape page {p}. Continuing.")
+            incomplete.append(p)
+            continue
+        missing = pages[p]["remaining"] + pages[p]["failed"]
+        if missing:
+            # Given up on, or still queued when the workers stopped
+            print(f"Page {p} is incomplete: {missing} works not scraped.")
+            incomplete.append(p)
+        work_details += [work for work in pages[p]["works"] if work is not None]
+    if incomplete:
+        print(f"Incomplete pages: {incomplete}")
 
     return work_details
 
@@ -301,22 +925,121 @@ PROXIES = [
     ("us-dc.proxymesh.com", 31280),
 ]
 
+# "http" fetches raw HTML over pooled sessions; "selenium" drives Firefox
+FETCH_BACKEND = "http"
+
+# Run one worker per proxy in parallel instead of walking pages one by one
+CONCURRENT_CRAWL = True
+
+# Raw HTML is cached here (e.g. "cache") so parsing can be re-run offline;
+# None, the default, disables it. Work pages are served from the cache
+# within CACHE_TTL, search listings always come from the site.
+CACHE_DIR = None
+CACHE_TTL = 30 * 24 * 60 * 60
+
+# Finished pages are streamed here so a restarted run picks up where it left off
+CHECKPOINT_DIR = "checkpoints"
+
+# Earlier outputs (CSV or Parquet files, folders of them, checkpoint folders)
+# whose works are only fetched again if the listing shows they changed
+PREVIOUS_OUTPUTS = []
+
+# Search query with a {mos} placeholder for the revised_at window
+BASE_QUERY_TEMPLATE = "https://archiveofourown.org/works/search?work_search%5Bquery%5D=%28%22Fluff%22+OR+%22Alternate+Universe%22+OR+%22Angst%22+OR+%22Hurt%2FComfort%22+OR+%22Family%22+OR+%22Friendship%22+OR+%22Not+Canon+Compliant%22+OR+%22Humor%22+OR+%22Alternate+Universe+-+Canon+Divergence%22%29++NOT+%28%22Sexual+Content%22+OR+%22Sex%22+OR+%22Smut%22+OR+%22Oral+Sex%22+OR+%22BDSM%22+OR+%22Porn%22+OR+%22Anal%22+OR+%22Anal+Sex%22+OR+%22Fingerfucking%22+OR+%22Non-Consensual%22+OR+%22Plot+What+Plot%2FPorn+Without+Plot%22+OR+%22Dom%2Fsub%22+OR+%22Blow+Jobs%22+OR+%22Consent%22+OR+%22Rape%2FNon-con+Elements%22+OR+%22Vaginal%22+OR+%22Bodily+Fluids%22+OR+%22Kinks%22+OR+%22Homosexuality%22+OR+%22Cuddling+%26+Snuggling%22+OR+%22Child+Abuse%22+OR+%22Gay%22+OR+%22Familial+Abuse%22+OR+%22Fluff+and+Smut%22+OR+%22Roughness%22%29&work_search%5Btitle%5D=&work_search%5Bcreators%5D=&work_search%5Brevised_at%5D={mos}&work_search%5Bcomplete%5D=T&work_search%5Bcrossover%5D=&work_search%5Bsingle_chapter%5D=0&work_search%5Bword_count%5D=&work_search%5Blanguage_id%5D=en&work_search%5Bfandom_names%5D=&work_search%5Brating_ids%5D=&work_search%5Bcharacter_names%5D=&work_search%5Brelationship_names%5D=&work_search%5Bfreeform_names%5D=&work_search%5Bhits%5D=%3E2000&work_search%5Bkudos_count%5D=&work_search%5Bcomments_count%5D=&work_search%5Bbookmarks_count%5D=&work_search%5Bsort_column%5D=_score&work_search%5Bsort_direction%5D=desc&commit=Search"
+# BASE_QUERY_TEMPLATE = "https://archiveofourown.org/works/search?work_search[query]=&work_search[hits]=%3E100&work_search[language_id]=en"
+
 START_MONTH = 48
 END_MONTH = 54
 
-if __name__ == "__main__":
-    proxy_rotator = ProxyRotator(PROXIES)
 
-    mos = f"{START_MONTH}-{END_MONTH}+months"
+def plan_worker_proxies(proxies, worker, num_workers):
+    """The proxies plan worker `worker` of `num_workers` crawls through.
+
+    Returns (proxies, rate_share) for its ProxyPool. While there are enough
+    to go round, every worker gets its own proxies at their full rate;
+    otherwise all workers share every proxy, each at 1/num_workers of it.
+    """
+    proxies = list(dict.fromkeys(proxies))
+    if num_workers <= len(proxies):
+        return proxies[worker::num_workers], 1.0
+    return proxies, 1.0 / num_workers
+
+
+def scrape_to_file(start_num, end_num, base_query, csv_name, proxy_pool, cache, index):
+    """Scrape one slice of pages of a query and save it as `csv_name`."""
+    checkpoint = None
+    if CHECKPOINT_DIR:
+        checkpoint = Checkpoint(CHECKPOINT_DIR, resolve_query(base_query))
+    if CONCURRENT_CRAWL:
+        work_details = scrape_all_pages_concurrent(
+            start_num,
+            end_num,
+            base_query,
+            proxy_pool,
+            cache=cache,
+            checkpoint=checkpoint,
+            index=index,
+        )
+    else:
+        work_details = scrape_all_pages(
+            start_num,
+            end_num,
+            base_query,
+            proxy_pool,
+            cache=cache,
+            checkpoint=checkpoint,
+            index=index,
+        )
+    if checkpoint is not None:
+        # Other slices of the same query may share the checkpoint; their
+        # works are streamed from its shards into the output
+        work_details = checkpoint.works(start_num, end_num)
+    make_csv(work_details, csv_name)
 
-    base_query = f"https://archiveofourown.org/works/search?work_search%5Bquery%5D=%28%22Fluff%22+OR+%22Alternate+Universe%22+OR+%22Angst%22+OR+%22Hurt%2FComfort%22+OR+%22Family%22+OR+%22Friendship%22+OR+%22Not+Canon+Compliant%22+OR+%22Humor%22+OR+%22Alternate+Universe+-+Canon+Divergence%22%29++NOT+%28%22Sexual+Content%22+OR+%22Sex%22+OR+%22Smut%22+OR+%22Oral+Sex%22+OR+%22BDSM%22+OR+%22Porn%22+OR+%22Anal%22+OR+%22Anal+Sex%22+OR+%22Fingerfucking%22+OR+%22Non-Consensual%22+OR+%22Plot+What+Plot%2FPorn+Without+Plot%22+OR+%22Dom%2Fsub%22+OR+%22Blow+Jobs%22+OR+%22Consent%22+OR+%22Rape%2FNon-con+Elements%22+OR+%22Vaginal%22+OR+%22Bodily+Fluids%22+OR+%22Kinks%22+OR+%22Homosexuality%22+OR+%22Cuddling+%26+Snuggling%22+OR+%22Child+Abuse%22+OR+%22Gay%22+OR+%22Familial+Abuse%22+OR+%22Fluff+and+Smut%22+OR+%22Roughness%22%29&work_search%5Btitle%5D=&work_search%5Bcreators%5D=&work_search%5Brevised_at%5D={mos}&work_search%5Bcomplete%5D=T&work_search%5Bcrossover%5D=&work_search%5Bsingle_chapter%5D=0&work_search%5Bword_count%5D=&work_search%5Blanguage_id%5D=en&work_search%5Bfandom_names%5D=&work_search%5Brating_ids%5D=&work_search%5Bcharacter_names%5D=&work_search%5Brelationship_names%5D=&work_search%5Bfreeform_names%5D=&work_search%5Bhits%5D=%3E2000&work_search%5Bkudos_count%5D=&work_search%5Bcomments_count%5D=&work_search%5Bbookmarks_count%5D=&work_search%5Bsort_column%5D=_score&work_search%5Bsort_direction%5D=desc&commit=Search"
-    # base_query = f"https://archiveofourown.org/works/search?work_search[query]=&work_search[hits]=%3E100&work_search[language_id]=en"
 
-    start_num = 801
-    end_num = 1000
-    work_details = scrape_all_pages(start_num, end_num, base_query)
-    # csv_name = get_date_range_from_string(mos)
-    csv_name = f"{start_num}-{end_num}"
-    make_csv(work_details, csv_name)
+if __name__ == "__main__":
+    cache = ResponseCache(CACHE_DIR, ttl=CACHE_TTL) if CACHE_DIR else None
+    index = WorkIndex.from_outputs(PREVIOUS_OUTPUTS)
+
+    if len(sys.argv) == 3:
+        # Run this worker's share of a plan written by planner.py. Workers
+        # run in parallel, so each keeps to its own proxies (or its share of
+        # them) and the per-proxy rates hold across all of them.
+        plan_path, worker = sys.argv[1], int(sys.argv[2])
+        with open(plan_path, "r") as file:
+            plan = json.load(file)
+        proxies, rate_share = plan_worker_proxies(
+            PROXIES, worker, len(plan["workers"])
+        )
+        proxy_pool = ProxyPool(proxies, backend=FETCH_BACKEND, rate_share=rate_share)
+        for task in plan["workers"][worker]["tasks"]:
+            mos = task["mos"]
+            base_query = BASE_QUERY_TEMPLATE.format(mos=mos)
+            date_range = get_date_range_from_string(mos)
+            csv_name = f"{date_range} {task['start_page']}-{task['end_page']}"
+            scrape_to_file(
+                task["start_page"],
+                task["end_page"],
+                base_query,
+                csv_name,
+                proxy_pool,
+                cache,
+                index,
+            )
+    else:
+        proxy_pool = ProxyPool(PROXIES, backend=FETCH_BACKEND)
+        mos = f"{START_MONTH}-{END_MONTH}+months"
+        base_query = BASE_QUERY_TEMPLATE.format(mos=mos)
+
+        start_num = 801
+        end_num = 1000
+        # csv_name = get_date_range_from_string(mos)
+        csv_name = f"{start_num}-{end_num}"
+        scrape_to_file(
+            start_num, end_num, base_query, csv_name, proxy_pool, cache, index
+        )
 
-    print("Scraping complete. Data saved to csv.")
+    proxy_pool.report()
+    proxy_pool.close()
+    print(f"Skipped {index.skipped} unchanged works")
+    print("Scraping complete. Data saved to csv and parquet.")
@@ -0,0 +1,116 @@
+import glob
+import os
+import threading
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from checkpoint import iter_shard_records
+
+DATE_KEYS = ["Revised", "Updated", "Completed", "Published"]
+
+
+def work_version(metadata):
+    """(last revised date, chapters) of a work from its scraped metadata.
+
+    Works scraped before listing dates were kept have no "Revised", so the
+    latest of their own dates stands in for it.
+    """
+    dates = []
+    for key in DATE_KEYS:
+        value = metadata.get(key)
+        if isinstance(value, str) and value:
+            dates.append(value[:10])
+            # The listing date is authoritative when we have it
+            if key == "Revised":
+                break
+
+    chapters = metadata.get("Chapters")
+    if isinstance(chapters, str):
+        chapters = "".join(chapters.split())
+    else:
+        chapters = None
+    return (max(dates) if dates else None, chapters)
+
+
+class WorkIndex:
+    """URL-keyed index of the works we already hold and their last version.
+
+    `changed` filters search listing entries down to works that are new, or
+    whose revision date or chapter count differs from what we stored.
+    """
+
+    def __init__(self):
+        self.works = {}
+        self.skipped = 0
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_outputs(cls, paths):
+        """Build an index from CSV/Parquet tables, folders of them and checkpoints."""
+        index = cls()
+        for path in paths:
+            if os.path.isdir(path):
+                table_paths = glob.glob(os.path.join(path, "**", "*.csv"), recursive=True)
+                table_paths += glob.glob(
+                    os.path.join(path, "**", "*.parquet"), recursive=True
+                )
+                shard_dirs = {
+                    os.path.dirname(shard)
+                    for shard in glob.glob(
+                        os.path.join(path, "**", "works-*.jsonl.gz"), recursive=True
+                    )
+                }
+            else:
+                table_paths = [path]
+                shard_dirs = set()
+
+            for table_path in table_paths:
+                index.add_table(table_path)
+            for shard_dir in shard_dirs:
+                for record in iter_shard_records(shard_dir):
+                    if record.get("text", "").strip():
+                        index.add_work(record)
+
+        print(f"Indexed {len(index.works)} previously scraped works")
+        return index
+
+    def add_table(self, path):
+        # Only the version columns; the text column is the bulk of the file
+        wanted = {"url", "Chapters"} | set(DATE_KEYS)
+        if path.endswith(".parquet"):
+            columns = pq.read_schema(path).names
+            df = pd.read_parquet(path, columns=[col for col in columns if col in wanted])
+            for col in DATE_KEYS:
+                if col in df.columns and pd.api.types.is_datetime64_any_dtype(df[col]):
+                    df[col] = df[col].dt.strftime("%Y-%m-%d")
+        else:
+            df = pd.read_csv(path, usecols=lambda col: col in wanted, dtype=str)
+
+        for record in df.to_dict("records"):
+            self.works[record["url"]] = work_version(record)
+
+    def add_work(self, work_info):
+        if work_info.get("metadata"):
+            with self.lock:
+                self.works[work_info["url"]] = work_version(work_info["metadata"])
+
+    def is_known(self, entry):
+        """Whether we hold some version of the work, current or not."""
+        return entry["link"].split("?")[0] in self.works
+
+    def is_current(self, entry):
+        url = entry["link"].split("?")[0]
+        stored = self.works.get(url)
+        if stored is None:
+            return False
+
+        revised, chapters = stored
+        return entry["revised"] == revised and entry["chapters"] == chapters
+
+    def changed(self, entries):
+        """The listing entries whose works have to be fetched."""
+        changed = [entry for entry in entries if not self.is_current(entry)]
+        with self.lock:
+            self.skipped += len(entries) - len(changed)
+        return changed